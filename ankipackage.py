@@ -0,0 +1,62 @@
+"""
+Writing anki packages without copying their media around.
+
+genanki.Package reads every media file from a path of its own. Here, media can
+also be given as bytes, or as a function opening it, like a member of the
+previous build of a package. Each one is streamed into the zip in chunks, so
+the memory needed doesn't grow with the size of the deck.
+"""
+
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+import genanki
+
+def write_package(deck, media, file_name, chunk_size=1024**2):
+    """Write a deck and its media to an .apkg.
+
+    The package is written next to file_name first and then moved there, so
+    media can be read from an earlier package at file_name while writing.
+
+    deck -- the genanki.Deck to write
+    media -- pairs of the name of a media and its content: the path of a file,
+             bytes, or a function returning a file object opened for reading
+    file_name -- where to write the .apkg
+    chunk_size -- how many bytes of media to hold in memory at once
+    """
+    handle, database_file_name = tempfile.mkstemp()
+    os.close(handle)
+    part_file_name = file_name + ".part"
+    try:
+        connection = sqlite3.connect(database_file_name)
+        timestamp = time.time()
+        ids = itertools.count(int(timestamp * 1000))
+        genanki.Package(deck).write_to_db(connection.cursor(), timestamp, ids)
+        connection.commit()
+        connection.close()
+
+        with zipfile.ZipFile(part_file_name, 'w') as package_file:
+            package_file.write(database_file_name, 'collection.anki2')
+            package_file.writestr('media',
+                                  json.dumps({str(index): name for index,
+                                              (name, _) in enumerate(media)}))
+            for index, (_, content) in enumerate(media):
+                if isinstance(content, bytes):
+                    package_file.writestr(str(index), content)
+                elif isinstance(content, str):
+                    package_file.write(content, str(index))
+                else:
+                    with content() as media_file, \
+                         package_file.open(str(index), 'w') as member:
+                        shutil.copyfileobj(media_file, member, chunk_size)
+        os.replace(part_file_name, file_name)
+    finally:
+        os.remove(database_file_name)
+        if os.path.exists(part_file_name):
+            os.remove(part_file_name)
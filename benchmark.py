@@ -0,0 +1,381 @@
+"""
+Benchmark choir2anki on synthetic songs of increasing length.
+
+Songs in the style of the Physikerchor files are generated with many lyric
+shards, changes in \\time and \\key, ties and slurs. The python stages are
+timed on their own, the whole pipeline with fake lilypond, timidity, lame,
+lilypond-book, latex and dvipng executables that only write placeholder files.
+For every stage, the exponent of its growth with the length of the song is
+estimated, so that accidentally quadratic code stands out. How long
+choir2anki takes to start, and whether that imports abjad or genanki, is
+measured as well.
+
+Dependencies: the ones of choir2anki, minus the external tools
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import choir2anki
+from profiler import profiler
+
+# Stands in for all external tools, telling them apart by the name it's called
+fake_tool_script = r'''#!{python}
+import os
+import re
+import sys
+
+tool = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+
+def touch(file_name, data=b"fake"):
+    with open(file_name, "wb") as out_file:
+        out_file.write(data)
+
+if tool == "lilypond":
+    source = args[-1]
+    if "--png" in args:
+        output = args[args.index("-o") + 1] if "-o" in args else source[:-3]
+        with open(source) as source_file:
+            suffixes = re.findall(r'bookOutputSuffix "([^"]*)"',
+                                  source_file.read())
+        for suffix in suffixes or [None]:
+            touch((output + "-" + suffix if suffix else output)
+                  + ".preview.png")
+    else:
+        touch(source[:-3] + ".midi")
+elif tool == "timidity":
+    sys.stdout.buffer.write(bytes(44100 * 4)) # 1s of silence
+elif tool == "lame":
+    if args[-2] == "-":
+        sys.stdin.buffer.read()
+    touch(args[-1])
+elif tool == "lilypond-book":
+    output = args[args.index("--output") + 1]
+    os.makedirs(output, exist_ok=True)
+    base_name = os.path.basename(args[-1])[:-3]
+    with open(args[-1], "rb") as source_file:
+        touch(os.path.join(output, base_name + ".tex"), source_file.read())
+elif tool == "latex":
+    with open(args[-1], "rb") as source_file:
+        touch(args[-1][:-4] + ".dvi", source_file.read())
+elif tool == "dvipng":
+    with open(args[-1]) as source_file:
+        pages = max(1, source_file.read().count(r"\begin{{lilypond}}"))
+    for page in range(1, pages + 1):
+        touch(args[-1][:-4] + str(page) + ".png")
+'''
+fake_tools = ["lilypond", "timidity", "lame", "lilypond-book", "latex",
+              "dvipng"]
+
+song_template = r'''\version "2.18.2"
+\header {{
+  title = "Synthetic {measures}"
+}}
+global = {{
+  \key c \major
+  \time 4/4
+  \partial 4
+}}
+bass = \relative c {{
+  \global
+  {notes}
+}}
+verse = \lyricmode {{
+  {lyrics}
+}}
+\score {{
+  \new Staff << \new Voice = "bass" \bass >>
+  \layout {{ }}
+  \midi {{ \tempo 4=100 }}
+}}
+'''
+
+# Too slow to import for choir2anki to load them before they are needed
+heavy_modules = ["abjad", "genanki"]
+
+rhythms = {"4/4": [["4", "4", "4", "4"], ["2", "4", "4"], ["4.", "8", "2"],
+                   ["8", "8", "4", "2"], ["2", "2"], ["1"]],
+           "3/4": [["4", "4", "4"], ["2", "4"], ["4.", "8", "4"], ["2."]]}
+pitches = ["c", "d", "e", "f", "g", "a", "b", "fis", "bes"]
+keys = [r"\key c \major", r"\key g \major", r"\key f \major",
+        r"\key es \major", r"\key a \minor"]
+
+def generate_song(measures, seed=0):
+    """Write a song of the given number of measures, after a pickup.
+
+    Every 16 measures, the time or the key changes. About every third note is
+    tied to the next or starts a slur. The lyrics are split into shards of
+    mostly 3 to 8 syllables, which is about one shard every two measures.
+
+    return -- the content of the .ly file
+    """
+    generator = random.Random(seed)
+    time_signature = "4/4"
+    tokens = ["c4", "|"] # The pickup
+    singable = 1
+    time_changes = set() # Where the syllables are when the time changes
+    for measure in range(measures):
+        if measure % 16 == 15:
+            if generator.random() < 0.5:
+                time_signature = "3/4" if time_signature == "4/4" else "4/4"
+                tokens += [r"\time " + time_signature]
+                time_changes.add(singable)
+            else:
+                tokens += [generator.choice(keys)]
+        rhythm = generator.choice(rhythms[time_signature])
+        slurred = False
+        tied = False
+        pitch = None
+        for position, duration in enumerate(rhythm):
+            is_last = position == len(rhythm) - 1
+            if tied: # A tie needs the same pitch again
+                token = pitch + duration
+            elif generator.random() < 0.1 and not slurred:
+                token = "r" + duration
+                pitch = None
+            else:
+                pitch = generator.choice(pitches)
+                token = pitch + duration
+            if not tied and not slurred and pitch:
+                singable += 1
+            tied = False
+            if slurred:
+                token += ")"
+                slurred = False
+            elif pitch and not is_last and generator.random() < 0.35:
+                if generator.random() < 0.5:
+                    token += "~"
+                    tied = True
+                else:
+                    token += "("
+                    slurred = True
+            tokens += [token]
+        tokens += ["|"]
+
+    syllables = []
+    shard = []
+    shard_size = generator.randint(3, 8)
+    for syllable in range(singable):
+        # choir2anki can't end a shard on a change in \time, so don't ask it to
+        if (len(shard) >= shard_size and singable - syllable >= 3
+                and syllable not in time_changes):
+            syllables += [" ".join(shard), "%{{{}%}}".format(len(syllables))]
+            shard = []
+            shard_size = generator.randint(3, 8)
+        shard += ["-- la" if shard and generator.random() < 0.3 else "la"]
+    syllables += [" ".join(shard)]
+    lyrics = " ".join(syllables)
+
+    lines = []
+    for start in range(0, len(tokens), 12):
+        lines += [" ".join(tokens[start:start + 12])]
+    return song_template.format(measures=measures,
+                                notes="\n  ".join(lines),
+                                lyrics=lyrics)
+
+def install_fake_tools(directory):
+    '''Put the fake external tools into directory and in front of the PATH.'''
+    script = fake_tool_script.format(python=sys.executable)
+    for tool in fake_tools:
+        path = os.path.join(directory, tool)
+        with open(path, "w") as tool_file:
+            tool_file.write(script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    os.environ["PATH"] = directory + os.pathsep + os.environ["PATH"]
+
+def plan_song(source_file_name):
+    '''Run the python stages of choir2anki on a song, rendering nothing.'''
+    with profiler.stage("extract voices", source_file_name):
+        info = choir2anki.extract_information_from_source(source_file_name)
+    songtitle, global_options, relative, tempo, notes, lyrics, voice = info
+    return choir2anki.plan_shards(songtitle, global_options, tempo, relative,
+                                  notes, lyrics, voice, "benchmark")
+
+def time_stages(run, repeat):
+    """Time all stages of several runs, keeping the fastest of each.
+
+    run -- a function without arguments, running the stages
+    repeat -- how often to run it
+    return -- the seconds spent in each stage, including 'wall time'
+    """
+    fastest = {}
+    for _ in range(repeat):
+        choir2anki.parse_lilypond.cache_clear()
+        choir2anki.plan_shards.cache_clear()
+        profiler.collect()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()): # Progress messages
+            run()
+        wall_time = time.perf_counter() - start
+        report = profiler.report(wall_time)
+        seconds = {name: stage["total"]
+                   for name, stage in report["stages"].items()}
+        seconds["wall time"] = wall_time
+        for name, stage_seconds in seconds.items():
+            fastest[name] = min(fastest.get(name, stage_seconds),
+                                stage_seconds)
+    return fastest
+
+def measure_startup(repeat):
+    """Time starting python and choir2anki, and find heavy imports.
+
+    repeat -- how often to start each one, the fastest start counts
+    return -- the seconds to start python and to run 'choir2anki.py --help',
+              and which of the heavy_modules 'import choir2anki' loads
+    """
+    script = os.path.abspath(choir2anki.__file__)
+    commands = {"python": [sys.executable, "-c", "pass"],
+                "choir2anki --help": [sys.executable, script, "--help"]}
+    startup = {}
+    for name, command in commands.items():
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+            seconds = time.perf_counter() - start
+            startup[name] = min(startup.get(name, seconds), seconds)
+    modules = subprocess.run([sys.executable, "-c",
+                              "import sys, choir2anki; print(*sys.modules)"],
+                             cwd=os.path.dirname(script),
+                             stdout=subprocess.PIPE, check=True,
+                             universal_newlines=True).stdout.split()
+    startup["heavy imports"] = [module for module in heavy_modules
+                                if module in modules]
+    return startup
+
+def format_startup(startup):
+    '''Format the startup times, marking heavy imports with a '!'.'''
+    lines = ["startup [s]"]
+    lines += ["{:<20}{:>10.4f}".format(name, seconds)
+              for name, seconds in startup.items() if name != "heavy imports"]
+    if startup["heavy imports"]:
+        lines += ["! 'import choir2anki' loads "
+                  + ", ".join(startup["heavy imports"])]
+    return "\n".join(lines)
+
+def growth_exponent(sizes, seconds):
+    '''Fit seconds ~ size**exponent by least squares on a log-log scale.'''
+    points = [(math.log(size), math.log(s))
+              for size, s in zip(sizes, seconds) if s > 0]
+    if len(points) < 2:
+        return float("nan")
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x)**2 for x, _ in points)
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    return covariance / variance
+
+def format_table(title, sizes, results, threshold):
+    """Format the seconds per stage and size, with the growth exponents.
+
+    Stages growing faster than size**threshold are marked with a '!'.
+    """
+    lines = [title,
+             "{:<20}".format("stage")
+             + "".join("{:>10}".format(size) for size in sizes)
+             + "{:>10}".format("exponent")]
+    stages = sorted(set(name for result in results for name in result),
+                    key=lambda name: -results[-1].get(name, 0))
+    for name in stages:
+        seconds = [result.get(name, 0) for result in results]
+        exponent = growth_exponent(sizes, seconds)
+        lines += ["{:<20}".format(name)
+                  + "".join("{:>10.4f}".format(s) for s in seconds)
+                  + "{:>9.2f}{}".format(exponent,
+                                        "!" if exponent > threshold else " ")]
+    return "\n".join(lines)
+
+def main(sizes, repeat=3, jobs=1, pipeline=True, threshold=1.5,
+         json_file_name=None):
+    """Benchmark all sizes and print the tables.
+
+    sizes -- the numbers of measures of the synthetic songs
+    repeat -- how often each song is run, the fastest run counts
+    jobs -- number of concurrent render jobs of the pipeline
+    pipeline -- whether to run the whole pipeline with the fake tools, too
+    threshold -- the growth exponent above which a stage is marked
+    json_file_name -- where to write all results as JSON, if anywhere
+    """
+    profiler.enabled = True
+    results = {"sizes": sizes, "python": [], "pipeline": [],
+               "startup": measure_startup(repeat)}
+    working_directory = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="choir2anki_benchmark_")
+    try:
+        install_fake_tools(directory)
+        os.chdir(directory)
+        for size in sizes:
+            source_file_name = "synthetic_{}.ly".format(size)
+            with open(source_file_name, "w") as source_file:
+                source_file.write(generate_song(size, seed=size))
+            if size == sizes[0]: # Build the parsers before timing anything
+                with contextlib.redirect_stdout(io.StringIO()):
+                    plan_song(source_file_name)
+            print("Benchmarking {} measures...".format(size), file=sys.stderr)
+            results["python"] += [time_stages(
+                                        lambda: plan_song(source_file_name),
+                                        repeat)]
+            if pipeline:
+                results["pipeline"] += [time_stages(
+                                    lambda: choir2anki.main([source_file_name],
+                                                            jobs=jobs,
+                                                            incremental=False),
+                                    repeat)]
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(directory)
+
+    print(format_startup(results["startup"]))
+    print()
+    print(format_table("python stages [s]", sizes, results["python"],
+                       threshold))
+    if pipeline:
+        print()
+        print(format_table("pipeline with fake tools [s]", sizes,
+                           results["pipeline"], threshold))
+    if json_file_name:
+        with open(json_file_name, "w") as json_file:
+            json.dump(results, json_file, indent=1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    description="Benchmark choir2anki on synthetic songs.")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[16, 32, 64, 128, 256],
+                        help="numbers of measures of the synthetic songs "
+                             "(default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per song, the fastest counts "
+                             "(default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of concurrent render jobs of the "
+                             "pipeline, 0 for one per CPU core "
+                             "(default: %(default)s)")
+    parser.add_argument("--python-only", action="store_true",
+                        help="skip the pipeline with the fake tools")
+    parser.add_argument("--threshold", type=float, default=1.5,
+                        help="mark stages growing faster than size to this "
+                             "power (default: %(default)s)")
+    parser.add_argument("--json", metavar="FILE",
+                        help="also write all results as JSON to FILE")
+    parser.add_argument("--write-song", type=int, metavar="MEASURES",
+                        help="only print a synthetic song of that many "
+                             "measures")
+    args = parser.parse_args()
+    if args.write_song:
+        print(generate_song(args.write_song, seed=args.write_song), end='')
+    else:
+        main(args.sizes, repeat=args.repeat, jobs=args.jobs or None,
+             pipeline=not args.python_only, threshold=args.threshold,
+             json_file_name=args.json)
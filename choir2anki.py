@@ -1,107 +1,435 @@
 """
 A script to transform an annotated lilypond file into an anki deck.
 
-Dependencies: abjad, lilypond, latex, timidity, lame, genanki,
+Dependencies: abjad, lilypond, latex, dvipng (or dvisvgm),
+              timidity (or numpy), lame (or oggenc, opusenc), genanki,
 """
 
 tmp_folder = "OUTPUT__TMP"
+cross_check = False # Verify the abjad-free fast paths against abjad
 
+# abjad and genanki take most of a second to import, so they are only imported
+# by the stages that need them. That way, --help, handing a job to a daemon or
+# a rebuild restoring all notes from cache never pay for them. The same goes
+# for asyncio, which only the rendering needs.
 import re
 import os
+import collections
+import contextlib
+import functools
 import shutil
-import subprocess
+import sys
+import time
+from fractions import Fraction
 import uuid
-import genanki
-import abjad
+import zipfile
 import argparse
 from string import Template
-from choirnote import * # Barely any namespace pollution, I promise
-
-def create_mp3(source_file_name, mp3_name=None, remove_source=False):
+from rendercache import RenderCache, default_cache_dir, default_max_size, \
+                        tool_fingerprint
+from renderdaemon import serve, submit_job, default_socket_path
+from deckmanifest import shard_hashes, restore_media, write_manifest, \
+                         archived_media, collapse_whitespace
+from profiler import profiler
+from lilytokens import DurationIndex, get_token_durations, format_duration, \
+                       read_duration, relative_to_absolute, lex_notes, \
+                       remove_comments, scan_first_level, read_header_title
+from midiwriter import write_midi, read_notes
+from synthesizer import timbres
+from workspace import Workspace
+
+# How the scores are written: as .png or .svg, at how many dots per inch and,
+# for .pngs, in which colors. A resolution of None leaves it to the tools.
+# "grey" keeps the shades of antialiasing in a single channel or a palette,
+# "mono" only keeps black and white, at one bit per pixel.
+ImageFormat = collections.namedtuple('ImageFormat', ['format', 'resolution',
+                                                     'colors'])
+default_image = ImageFormat("png", None, "full")
+
+def image_extension(image):
+    '''Return the file extension of scores in the given ImageFormat.'''
+    return "." + image.format
+
+def latex_image_command(image):
+    """Return the command turning the pages of a .dvi into images.
+
+    The .dvi still has to be appended. Like dvipng, dvisvgm numbers the images
+    of the pages from 1, right after the name of the .dvi.
+
+    image -- the ImageFormat to write
+    """
+    if image.format == "svg": # Glyphs as paths, a webview has no TeX fonts
+        return ["dvisvgm", "--no-fonts", "--page=1-", "--output=%f%p.svg"]
+    command = ["dvipng"]
+    if image.resolution:
+        command += ["-D", str(image.resolution)]
+    if image.colors == "grey":
+        command += ["--palette", "-z", "9"]
+    elif image.colors == "mono":
+        command += ["--palette", "-Q", "1", "-z", "9"]
+    return command
+
+def latex_image_tools(image):
+    '''Return the tools typesetting scores with latex.'''
+    return ["lilypond-book", "latex", latex_image_command(image)[0]]
+
+def lilypond_image_command(image):
+    """Return the lilypond command writing a cropped image of every book.
+
+    The output and the .ly still have to be appended.
+
+    image -- the ImageFormat to write
+    """
+    if image.format == "svg":
+        return ["lilypond", "-dbackend=svg", "-dpreview", "-dno-print-pages"]
+    command = ["lilypond", "--png", "-dpreview", "-dno-print-pages"]
+    if image.resolution:
+        command += ["-dresolution={}".format(image.resolution)]
+    if image.colors == "grey":
+        command += ["-dpixmap-format=pnggray"]
+    elif image.colors == "mono":
+        command += ["-dpixmap-format=pngmono"]
+    return command
+
+def image_flags(image):
+    '''Return the command lines scores in the given ImageFormat depend on.'''
+    return (latex_image_tools(image) + latex_image_command(image)
+            + lilypond_image_command(image))
+
+# How the audio of the notes is encoded, and how many samples per second and
+# channels are synthesized for it, by timidity or numpy in the given timbre.
+# A bitrate of None leaves it to the encoder. A single voice loses nothing in
+# mono, at half the size.
+AudioFormat = collections.namedtuple('AudioFormat', ['codec', 'bitrate',
+                                                     'sample_rate',
+                                                     'channels',
+                                                     'synthesizer', 'timbre'])
+default_audio = AudioFormat("mp3", None, 44100, 2, "timidity", "piano")
+
+# The encoder and the file extension of each codec
+audio_codecs = {"mp3": ("lame", ".mp3"),
+                "ogg": ("oggenc", ".ogg"),
+                "opus": ("opusenc", ".opus")}
+
+def audio_extension(audio):
+    '''Return the file extension of audio in the given AudioFormat.'''
+    return audio_codecs[audio.codec][1]
+
+def audio_tools(audio):
+    '''Return the tools turning notes into audio in the given AudioFormat.'''
+    if audio.synthesizer == "numpy":
+        return [audio_codecs[audio.codec][0]]
+    return ["timidity", audio_codecs[audio.codec][0]]
+
+# timidity streams raw 16 bit PCM to stdout, which the encoder reads on stdin
+def synthesizer_command(audio=default_audio):
+    '''Return the timidity command, still missing the .midi to synthesize.'''
+    channels = "M" if audio.channels == 1 else "S"
+    return ["timidity", "-Or{}1sl".format(channels),
+            "-s", str(audio.sample_rate), "-o", "-"]
+
+def encoder_command(audio, out_file_name):
+    """Return the command encoding raw PCM from stdin into out_file_name.
+
+    audio -- the AudioFormat of both the PCM and the encoded file
+    """
+    if audio.codec == "mp3":
+        command = ["lame", "-r", "-s", str(audio.sample_rate / 1000),
+                   "-m", "m" if audio.channels == 1 else "j",
+                   "--bitwidth", "16", "--signed", "--little-endian"]
+        if audio.bitrate:
+            command += ["-b", str(audio.bitrate)]
+        return command + ["-", out_file_name]
+    raw_options = ["--quiet", "--raw", "--raw-bits", "16",
+                   "--raw-chan", str(audio.channels),
+                   "--raw-rate", str(audio.sample_rate),
+                   "--raw-endianness", "0"]
+    if audio.bitrate:
+        raw_options += ["--bitrate", str(audio.bitrate)]
+    if audio.codec == "ogg":
+        return ["oggenc"] + raw_options + ["--output", out_file_name, "-"]
+    if audio.codec == "opus":
+        return ["opusenc"] + raw_options + ["-", out_file_name]
+    raise ValueError("unknown audio codec " + repr(audio.codec))
+
+def audio_flags(audio):
+    '''Return the command lines audio in the given AudioFormat depends on.'''
+    if audio.synthesizer == "numpy":
+        return (["numpy", audio.timbre, str(audio.sample_rate),
+                 str(audio.channels)] + encoder_command(audio, ""))
+    return synthesizer_command(audio) + encoder_command(audio, "")
+
+async def midi_to_mp3(tools, midi_file_name, mp3_file_name,
+                      audio=default_audio):
+    """Synthesize a .midi and encode it, without a .wav in between.
+
+    The PCM output of timidity is piped straight into the encoder. If either
+    of them fails, a ToolError carrying its stderr is raised.
+    """
+    await tools.pipe([synthesizer_command(audio) + [midi_file_name],
+                      encoder_command(audio, mp3_file_name)])
+
+async def synthesize_pcm(tools, midi_file_name, audio=default_audio):
+    """Synthesize a .midi and return the raw PCM produced by timidity."""
+    return await tools.run(synthesizer_command(audio) + [midi_file_name])
+
+async def pcm_to_mp3(tools, pcm, mp3_file_name, audio=default_audio):
+    """Encode raw PCM as produced by synthesize_pcm into an audio file."""
+    # Slices are encoded concurrently, label them here
+    label = os.path.splitext(os.path.basename(mp3_file_name))[0]
+    with profiler.stage("encode slice", label):
+        await tools.run(encoder_command(audio, mp3_file_name), input=pcm)
+
+async def create_mp3(tools, source_file_name, mp3_name=None,
+                     remove_source=False, cache=None, audio=default_audio):
     """Generate an .mp3 and write it to disk.
 
-    Given the file name of a (valid) lilypond file, write an .mp3 to the
-    current directory and return the file name of the .mp3. In both cases, the
+    Given the file name of a (valid) lilypond file, write an .mp3 to mp3_name
+    and return the file name of the .mp3. In both cases, the
     trailing '.ly' and '.mp3' are omitted except in the return value.
     If no file name for the .mp3 is provided, a uuid is assigned.
+    With another codec than mp3, its extension takes the place of '.mp3'.
 
+    tools -- the ToolScheduler to run the external tools with
     source_file_name -- the location of the .ly file, without file ending
     mp3_name -- the file name of the .mp3 (default: random uuid4)
     remove_source -- remove the lilypond after .mp3 is created (default: false)
+    cache -- a RenderCache to look up the .mp3 in before rendering it
+    audio -- the AudioFormat to encode in (default: stereo mp3 at 44.1 kHz)
     return -- the name of the created .mp3
     """
 
     if mp3_name == None:
         mp3_name = uuid.uuid4().hex
-
-    subprocess.run(["lilypond",
-            source_file_name + ".ly"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL) # For some reason, lilypond spams stderr
-    subprocess.run(["timidity",
-            "-Ow",
-            source_file_name + ".midi"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL)
-    subprocess.run(["lame",
-            source_file_name + ".wav"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL)
+    extension = audio_extension(audio)
+    if cache:
+        with open(source_file_name + ".ly") as source_file:
+            cache_key = cache.key(source_file.read(),
+                                  ["lilypond"] + audio_tools(audio),
+                                  audio_flags(audio))
+        if cache.fetch(cache_key, extension, mp3_name + extension):
+            if remove_source:
+                os.remove(source_file_name + ".ly")
+            return mp3_name + extension
+
+    await tools.run(["lilypond", "-o", source_file_name,
+            source_file_name + ".ly"]) # For some reason, lilypond spams stderr
+    await midi_to_mp3(tools, source_file_name + ".midi", mp3_name + extension,
+                      audio)
     os.remove(source_file_name + ".midi")
-    os.remove(source_file_name + ".wav")
-    shutil.move(source_file_name + ".mp3", mp3_name + ".mp3")
+    if cache:
+        cache.store(cache_key, extension, mp3_name + extension)
 
     if remove_source:
         os.remove(source_file_name + ".ly")
 
-    return mp3_name + ".mp3"
+    return mp3_name + extension
 
-def create_png(source_file_name, png_name=None, tmp_folder=tmp_folder,
-               remove_source=False):
-    """Typeset music and write to disk as .png.
+async def create_mp3_from_midi(tools, midi, mp3_name, cache=None,
+                               audio=default_audio, midi_name=None):
+    """Synthesize a .midi given as bytes and write the audio to disk.
 
-    Given the file name of a (valid) lilypond file, typeset the music on a
-    single line, create a .png and write it to the current directory. Then,
-    return the filename of the created .png.
+    tools -- the ToolScheduler to run the external tools with
+    midi -- the bytes of the .midi, as made by write_midi
+    mp3_name -- the file name of the .mp3, without file ending
+    cache -- a RenderCache to look up the .mp3 in before rendering it
+    audio -- the AudioFormat to encode in
+    midi_name -- where to write the .midi, without file ending (default: next
+                 to the .mp3)
+    return -- the name of the created .mp3
+    """
+    extension = audio_extension(audio)
+    midi_name = midi_name or mp3_name
+    if cache:
+        cache_key = cache.key(midi.hex(), audio_tools(audio),
+                              audio_flags(audio))
+        if cache.fetch(cache_key, extension, mp3_name + extension):
+            return mp3_name + extension
+
+    with open(midi_name + ".midi", 'wb') as midi_file:
+        midi_file.write(midi)
+    await midi_to_mp3(tools, midi_name + ".midi", mp3_name + extension, audio)
+    os.remove(midi_name + ".midi")
+    if cache:
+        cache.store(cache_key, extension, mp3_name + extension)
+    return mp3_name + extension
+
+async def create_synthesized_mp3(tools, played, end, tempo, mp3_name,
+                                 cache=None, audio=default_audio):
+    """Synthesize notes with numpy and encode them, without timidity.
+
+    The PCM is made in a worker thread and piped straight into the encoder.
+
+    tools -- the ToolScheduler to run the encoder with
+    played, end -- the notes and where they end, as read by read_notes
+    tempo -- a lilypond tempo like "4=100"
+    mp3_name -- the file name of the .mp3, without file ending
+    cache -- a RenderCache to look up the .mp3 in before rendering it
+    audio -- the AudioFormat to synthesize and encode in
+    return -- the name of the created .mp3
+    """
+    extension = audio_extension(audio)
+    if cache:
+        cache_key = cache.key(repr((played, end, tempo)), audio_tools(audio),
+                              audio_flags(audio))
+        if cache.fetch(cache_key, extension, mp3_name + extension):
+            return mp3_name + extension
+
+    pcm = await synthesize_with_numpy(tools, played, end, tempo, audio)
+    await tools.run(encoder_command(audio, mp3_name + extension), input=pcm)
+    if cache:
+        cache.store(cache_key, extension, mp3_name + extension)
+    return mp3_name + extension
+
+async def synthesize_with_numpy(tools, played, end, tempo, audio):
+    '''Synthesize notes read by read_notes into raw PCM, in a worker thread.'''
+    from synthesizer import synthesize
+    return await tools.call("numpy", synthesize, played, end,
+                            seconds_per_whole_note(tempo), audio.sample_rate,
+                            audio.channels, audio.timbre)
+
+def read_synthesized_notes(notes, global_options, audio):
+    """Read the notes for the numpy synthesizer, if it is chosen.
+
+    Notes read_notes doesn't understand are left to timidity instead.
+
+    return -- the notes and their end as read by read_notes, or None, and the
+              AudioFormat to synthesize them in
+    """
+    if audio.synthesizer != "numpy":
+        return None, audio
+    try:
+        played, _, end = read_notes(global_options + " " + notes)
+        return (played, end), audio
+    except ValueError:
+        profiler.count("timidity fallbacks")
+        return None, audio._replace(synthesizer="timidity")
+
+async def typeset_with_latex(tools, source_file_name, tmp_folder,
+                             image=default_image):
+    '''Run lilypond-book, latex and dvipng on a .ly, writing into tmp_folder.'''
+    base_name = os.path.basename(source_file_name)
+    await tools.run(["lilypond-book",
+            "-f",
+            "latex",
+            "--output",
+            tmp_folder,
+            source_file_name + ".ly"])
+    await tools.run(["latex",
+            base_name + ".tex"],
+            cwd=tmp_folder)
+    await tools.run(latex_image_command(image) + [
+            base_name + ".dvi"],
+            cwd=tmp_folder)
+
+async def create_lilypond_pngs(tools, source_file_name, png_name=None,
+                               tmp_folder=tmp_folder, remove_source=False,
+                               cache=None, image=default_image):
+    """Typeset music with lilypond alone and write it to disk as .pngs.
+
+    Given the file name of a filled png_lilypond_template, write a cropped
+    .png with and without lyrics to png_name, using a single run of lilypond
+    and no latex. Then, return the file names of both .pngs.
     The trailing '.ly' and '.png' are omitted except in the return value.
-    If no file name for the .png is provided, a uuid is assigned.
+    If no file name for the .png is provided, a uuid is assigned. .svgs take
+    the place of the .pngs if the image format asks for them.
 
+    tools -- the ToolScheduler to run the external tools with
     source_file_name -- the location of the .ly file, without file ending
-    png_name -- the file name of the .png (default: random uuid4)
+    png_name -- the file name of the .png, the one without lyrics gets a
+                '_no_lyrics' appended (default: random uuid4)
     tmp_folder -- a folder for intermediary files (default: "OUTPUT__TMP")
-    remove_source -- remove the lilypond after .mp3 is created (default: false)
-    return -- the name of the created .png
+    remove_source -- remove the lilypond after .png is created (default: false)
+    cache -- a RenderCache to look up the .pngs in before rendering them
+    image -- the ImageFormat to write (default: lilypond's own .pngs)
+    return -- the names of the .png with and without lyrics
     """
 
     if png_name == None:
         png_name = uuid.uuid4().hex
-
-    subprocess.run(["lilypond-book",
-            "-f",
-            "latex",
-            "--output",
-            tmp_folder,
-            source_file_name + ".ly"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL)
-    os.chdir(tmp_folder)
-    subprocess.run(["latex",
-            source_file_name + ".tex"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL)
-    subprocess.run(["dvipng",
-            source_file_name + ".dvi"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL)
-    os.chdir("..")
-    shutil.move(tmp_folder + "/" + source_file_name + "1.png",
-                "./" + png_name + ".png")
+    extension = image_extension(image)
+    png_names = [png_name + extension, png_name + "_no_lyrics" + extension]
+    suffixes = ["lyrics", "no_lyrics"]
+    command = lilypond_image_command(image)
+    if cache:
+        with open(source_file_name + ".ly") as source_file:
+            source = source_file.read()
+        cache_keys = [cache.key(source, ["lilypond"], command + [suffix])
+                      for suffix in suffixes]
+        if all(cache.fetch(cache_key, extension, name)
+               for cache_key, name in zip(cache_keys, png_names)):
+            if remove_source:
+                os.remove(source_file_name + ".ly")
+            return tuple(png_names)
+
+    output = os.path.join(tmp_folder, os.path.basename(source_file_name))
+    os.makedirs(tmp_folder, exist_ok=True)
+    await tools.run(command + ["-o", output, source_file_name + ".ly"])
+    for suffix, name in zip(suffixes, png_names):
+        shutil.move(output + "-" + suffix + ".preview" + extension, name)
     shutil.rmtree(tmp_folder)
+    if cache:
+        for cache_key, name in zip(cache_keys, png_names):
+            cache.store(cache_key, extension, name)
 
     if remove_source:
         os.remove(source_file_name + ".ly")
 
-    return png_name + ".png"
+    return tuple(png_names)
+
+async def create_pngs(tools, fragments, png_names,
+                      source_file_name="filled_png_batch",
+                      tmp_folder=tmp_folder, cache=None, image=default_image):
+    """Typeset many pieces of music at once and write them to disk as .pngs.
+
+    Each fragment is a filled png_fragment_template. All fragments that aren't
+    cached yet are put on the pages of a single document, so that
+    lilypond-book, latex and dvipng only need to be started once. The pages
+    numbered by dvipng are then moved to the corresponding png_names.
+    The trailing '.ly' and '.png' are omitted except in the return value.
+
+    tools -- the ToolScheduler to run the external tools with
+    fragments -- the filled png_fragment_templates to typeset
+    png_names -- the file names of the .pngs, one per fragment
+    source_file_name -- the name of the .ly holding the whole batch
+    tmp_folder -- a folder for intermediary files (default: "OUTPUT__TMP")
+    cache -- a RenderCache to look up the .pngs in before rendering them
+    image -- the ImageFormat to write, .svgs take the place of the .pngs
+    return -- the names of the created .pngs
+    """
+    extension = image_extension(image)
+    with profiler.label(os.path.basename(source_file_name)):
+        to_render = []
+        for fragment, png_name in zip(fragments, png_names):
+            cache_key = None
+            if cache:
+                cache_key = cache.key(fragment, latex_image_tools(image),
+                                      latex_image_command(image) + ["batch"])
+                if cache.fetch(cache_key, extension, png_name + extension):
+                    continue
+            to_render += [(fragment, png_name, cache_key)]
+
+        if to_render:
+            from choirnote import png_batch_template
+            pages = [r"\begin{standalone}" + fragment + r"\end{standalone}"
+                     for fragment, _, _ in to_render]
+            with open(source_file_name + ".ly", 'w') as out_file:
+                template = Template(png_batch_template)
+                out_file.write(template.substitute(fragments="\n".join(pages)))
+            base_name = os.path.basename(source_file_name)
+
+            await typeset_with_latex(tools, source_file_name, tmp_folder,
+                                     image)
+            for page, (_, png_name, cache_key) in enumerate(to_render, 1):
+                shutil.move(os.path.join(tmp_folder,
+                                         base_name + str(page) + extension),
+                            png_name + extension)
+                if cache:
+                    cache.store(cache_key, extension, png_name + extension)
+            shutil.rmtree(tmp_folder)
+            os.remove(source_file_name + ".ly")
+
+        return [png_name + extension for png_name in png_names]
 
 def fill_template_mp3(notes, out_file_name="filled_mp3_template",
                       global_options="", tempo='4=100'):
@@ -111,14 +439,15 @@ def fill_template_mp3(notes, out_file_name="filled_mp3_template",
     options["tempo"] = tempo
     options["global_options"] = global_options
 
+    from choirnote import mp3_template
     with open(out_file_name + ".ly", 'w') as out_file:
         template = Template(mp3_template)
         out_file_content = template.substitute(options)
         out_file.write(out_file_content)
     return out_file_name
 
-def fill_template_png(notes, out_file_name="filled_png_template", lyrics="",
-                      global_options="", clef="bass"):
+def fill_template_lilypond_png(notes, out_file_name="filled_png_template",
+                               lyrics="", global_options="", clef="bass"):
     """Given a template, fill it with the approriate options."""
     options = {}
     options["clef"] = clef
@@ -126,67 +455,103 @@ def fill_template_png(notes, out_file_name="filled_png_template", lyrics="",
     options["lyrics"] = lyrics
     options["global_options"] = global_options
 
+    from choirnote import png_lilypond_template
     with open(out_file_name + ".ly", 'w') as out_file:
-        template = Template(png_template)
+        template = Template(png_lilypond_template)
         out_file_content = template.substitute(options)
         out_file.write(out_file_content)
     return out_file_name
 
-def extract_information_from_source(source_file_name, voice='bass'):
-    '''Given a Physikerchor lilypond file, extract metadata, notes and lyrics'''
+def fill_png_fragment(notes, lyrics="", global_options="", clef="bass"):
+    """Fill the lilypond part of the png template, to be typeset in a batch."""
+    options = {}
+    options["clef"] = clef
+    options["notes"] = notes
+    options["lyrics"] = lyrics
+    options["global_options"] = global_options
+
+    from choirnote import png_fragment_template
+    return Template(png_fragment_template).substitute(options)
+
+@functools.lru_cache(maxsize=None)
+def get_parser(default_language='english'):
+    '''Return the shared LilyPondParser for a language.
+
+    Building a parser sets up its whole grammar, so there is only one per
+    language and process.
+    '''
+    import abjad
+    profiler.count("parser constructions")
+    return abjad.lilypondparsertools.LilyPondParser(
+                                            default_language=default_language)
+
+@functools.lru_cache(maxsize=1024)
+def parse_lilypond(string, default_language='english'):
+    '''Parse a lilypond string, remembering the results of recent calls.
+
+    The returned abjad objects are shared by all callers with the same input,
+    so they must only be inspected, never changed.
+    '''
+    with profiler.stage("abjad parse"):
+        return get_parser(default_language)(string)
+
+def extract_voices_from_source(source_file_name, voices=('bass',)):
+    '''Given a Physikerchor lilypond file, extract metadata and all voices.
+
+    The file is read and split into its blocks only once, no matter how many
+    voices are extracted. Voices missing from the file are left out.
+
+    return -- songtitle, global options, tempo and, per voice, its relative
+              pitch, notes and lyrics
+    '''
     with open(source_file_name) as input_file:
         input_string = input_file.read()
-    parser = abjad.lilypondparsertools.LilyPondParser()
 
-    trigger_words = [r"\header", "global", r"\score",
-                     voice + "Verse", "verse", voice]
+    trigger_words = [r"\header", "global", r"\score", "verse"]
+    for voice in voices:
+        trigger_words += [voice + "Verse", voice]
 
     # The lilypond parser has very limited functionality for now. Thus,
     # we need to extract the relevant blocks of information manually but
     # can then feed them to the parser to be less error prone than regexes.
-    def extract_from_first_level(trigger_words, input_string):
-        trigger_words = dict(zip(trigger_words, ['']*len(trigger_words)))
-        open_context = 0
-        encountered_context_begin = False
-        is_recording = False
-        recording_word = ''
-        # Keep whitespaces for line comments to keep working
-        for t in re.split(r'(\s+)', input_string):
-            open_context += t.count('{') - t.count('}')
-            open_context += t.count('<<') - t.count('>>')
-            if t in trigger_words.keys() and not is_recording and open_context <= 0:
-                is_recording = True
-                recording_word = t
-
-            if is_recording: # Add everything, keep track of {…} or <<…>> blocks
-                if t.count('{') >= 1 or t.count('<<') >= 1:
-                    encountered_context_begin = True
-                trigger_words[recording_word] += t
-
-            if open_context <= 0 and encountered_context_begin: # Reset
-                is_recording = False
-                open_context = 0
-                encountered_context_begin = False
-                recording_word = ''
-        return trigger_words
-
     clean_up = lambda kw, st : st.lstrip(kw).strip().strip('{|}').strip()
 
-    information = extract_from_first_level(trigger_words, input_string)
-    songtitle = parser(information[r"\header"]).title
-    verse = "verse"
-    if information[verse] == '':
-        verse = voice + "Verse"
-    lyrics = information[verse].split(r"\lyricmode")[1]
-    lyrics = clean_up("=", lyrics)
+    information = scan_first_level(input_string, trigger_words)
+    try:
+        songtitle = read_header_title(information[r"\header"])
+    except ValueError: # Leave \markup and the like to abjad
+        songtitle = None
+    if songtitle == None or cross_check:
+        profiler.count("abjad titles")
+        abjad_title = parse_lilypond(information[r"\header"]).title
+        check_fast_path(songtitle, abjad_title, information[r"\header"])
+        songtitle = abjad_title
     global_options = clean_up("global =", information["global"])
     score = clean_up(r"\score =", information[r"\score"])
-    midi = extract_from_first_level([r"\midi"], score)[r"\midi"]
+    midi = scan_first_level(score, [r"\midi"])[r"\midi"]
     tempo = re.search(r"\\tempo ([\d|=]*)", midi)[1]
-    relative = re.search(r"\\relative ([a-g]['|,]*)", information[voice])[1]
-    notes = clean_up(voice + r"= \relative " + relative, information[voice])
-    notes = notes.lstrip(r"\global").strip()
 
+    voice_information = {}
+    for voice in voices:
+        if information[voice] == '':
+            continue
+        verse = "verse"
+        if information[verse] == '':
+            verse = voice + "Verse"
+        lyrics = information[verse].split(r"\lyricmode")[1]
+        lyrics = clean_up("=", lyrics)
+        relative = re.search(r"\\relative ([a-g]['|,]*)", information[voice])[1]
+        notes = clean_up(voice + r"= \relative " + relative, information[voice])
+        notes = notes.lstrip(r"\global").strip()
+        voice_information[voice] = relative, notes, lyrics
+
+    return songtitle, global_options, tempo, voice_information
+
+def extract_information_from_source(source_file_name, voice='bass'):
+    '''Given a Physikerchor lilypond file, extract metadata, notes and lyrics'''
+    info = extract_voices_from_source(source_file_name, [voice])
+    songtitle, global_options, tempo, voice_information = info
+    relative, notes, lyrics = voice_information[voice]
     return songtitle, global_options, relative, tempo, notes, lyrics, voice
 
 def extract_key_time_partial(options):
@@ -216,6 +581,11 @@ def extract_key_time_partial(options):
 def encode_partial(abjad_duration):
     if abjad_duration == None:
         return None
+    try:
+        return format_duration(abjad_duration)
+    except ValueError: # Leave the odd ones to abjad
+        import abjad
+        abjad_duration = abjad.Duration(abjad_duration)
     try:
         partial = abjad_duration.lilypond_duration_string
     except abjad.AssignabilityError: # lilypond understands multiples
@@ -226,19 +596,37 @@ def encode_partial(abjad_duration):
 
 def decode_partial(partial):
     if partial == None or partial == "":
-        return abjad.Duration()
-    # Compensating for the multiples workaround
-    if partial.find('*') >= 0:
-        partial, numerator = partial.split('*')
-        partial = abjad.Duration(1, int(partial))
-        partial *= int(numerator)
-    else:
-        partial = abjad.Duration.from_lilypond_duration_string(partial)
-    return partial
+        return Fraction(0)
+    return read_duration(partial) # Knows the multiples workaround
+
+def check_fast_path(fast_result, abjad_result, notes):
+    '''In cross_check mode, make sure the abjad-free path got it right.'''
+    if fast_result != None and fast_result != abjad_result:
+        raise AssertionError("abjad-free path disagrees with abjad on {!r}: "
+                             "{!r} != {!r}".format(notes, fast_result,
+                                                   abjad_result))
+
+def get_notes_duration(notes):
+    '''Return the total duration of some notes as a Fraction.
+
+    Notes as formatted by create_absolute_notes are added up token by token,
+    anything else is left to abjad.
+    '''
+    try:
+        duration = sum(get_token_durations(notes.split())[0], Fraction(0))
+    except ValueError:
+        duration = None
+    if duration == None or cross_check:
+        import abjad
+        profiler.count("abjad durations")
+        abj_notes = parse_lilypond(r'\new Voice { ' + notes + r'}')
+        abjad_duration = abjad.inspect(abj_notes).get_duration()
+        check_fast_path(duration, abjad_duration, notes)
+        duration = abjad_duration
+    return duration
 
 def calculate_new_partial(partial, time, cur_notes):
     '''Calculate how much of the last measurement is left incompleted.'''
-    parser = abjad.lilypondparsertools.LilyPondParser()
     # If there was a change in \time, that implies completed measures and we
     # thus have to look only at the part after the last change of \time
     if cur_notes.find('\\time') >= 0:
@@ -256,11 +644,10 @@ def calculate_new_partial(partial, time, cur_notes):
         cur_notes = split_notes[-1]
 
     # With or without change in \time, see how incomplete last measurement is
-    abj_notes = parser(r'\new Voice { ' + cur_notes + r'}')
-    notes_duration = abjad.inspect(abj_notes).get_duration()
+    notes_duration = get_notes_duration(cur_notes)
     if partial:
         partial = decode_partial(partial)
-    time = abjad.Duration(time)
+    time = Fraction(time)
 
     if partial:
         notes_duration -= partial
@@ -273,18 +660,31 @@ def calculate_new_partial(partial, time, cur_notes):
         partial = encode_partial(partial)
     return partial
 
+def calculate_token_partial(partial, time, tokens):
+    '''Like calculate_new_partial, but for Tokens, mostly without abjad.'''
+    try:
+        decoded_partial = decode_partial(partial) if partial else None
+        return encode_partial(DurationIndex(tokens).get_partial(len(tokens),
+                                                               decoded_partial,
+                                                               time))
+    except ValueError: # Contains something only abjad understands
+        return calculate_new_partial(partial, time,
+                                     " ".join(t.text for t in tokens))
+
 def find_best_split(partial, time, left_note_shard, right_note_shard):
     '''Given two note shards, find the most natural splitting point.
 
     Rests are only expected on the end of the left shard, never at the
-    beginning of the right shard.
+    beginning of the right shard. Blocks, like the { } of a tuplet, are never
+    split. The shards are lists of Tokens, and so are
+    the returned ones.
     '''
     def contains_singable_note(lilypond_note_array, open_paranthesis):
         next_is_tie = False
         open_parantheses = 0
         for note in lilypond_note_array:
             is_singable, next_is_tie, open_parantheses =\
-                is_singable_note(note, next_is_tie, open_parantheses)
+                is_singable_note(note.text, next_is_tie, open_parantheses)
             if is_singable:
                 return True
         return False
@@ -294,10 +694,33 @@ def find_best_split(partial, time, left_note_shard, right_note_shard):
             return 0
         return abjad_duration.numerator + abjad_duration.denominator - 1
 
-    best_partial = calculate_new_partial(partial, time, left_note_shard)
-    best_partial = decode_partial(best_partial)
-    left_note_shard = left_note_shard.split()
-    right_note_shard = right_note_shard.split()
+    # Every candidate is a prefix of the left shard. Thus, durations and
+    # parantheses are counted once, making each candidate a cheap lookup.
+    try:
+        duration_index = DurationIndex(left_note_shard)
+    except ValueError: # Contains something only abjad understands
+        duration_index = None
+    decoded_partial = decode_partial(partial) if partial else None
+
+    def partial_after(end):
+        if duration_index:
+            try:
+                return duration_index.get_partial(end, decoded_partial, time)
+            except ValueError:
+                pass
+        new_partial = calculate_new_partial(
+                            partial,
+                            time,
+                            " ".join(t.text for t in left_note_shard[:end]))
+        return decode_partial(new_partial) if new_partial else None
+
+    opened = [0]
+    closed = [0]
+    for token in left_note_shard:
+        opened += [opened[-1] + token.slur_opens]
+        closed += [closed[-1] + token.slur_closes]
+
+    best_partial = partial_after(len(left_note_shard))
 
     splitpoint = 0
     contains_singable = True
@@ -305,60 +728,54 @@ def find_best_split(partial, time, left_note_shard, right_note_shard):
         left_split, right_split = (left_note_shard[:splitpoint],
                                    left_note_shard[splitpoint:])
         # can't split in the middle of a slur
-        open_paranthesis = "".join(left_split).count('(')
-        open_paranthesis -= "".join(left_split).count(')')
-        open_paranthesis += "".join(right_split).count('(') # don' move slurs!
+        open_paranthesis = opened[splitpoint] - closed[splitpoint]
+        open_paranthesis += opened[-1] - opened[splitpoint] # don' move slurs!
         if right_split != []:
-            starts_with_tie = right_split[0].endswith('~')
+            starts_with_tie = right_split[0].tie
         if open_paranthesis == 0 and not starts_with_tie:
             contains_singable = contains_singable_note(right_split,
                                                        open_paranthesis)
         splitpoint += 1
-    left_note_shard = left_split
+    movable_start = len(left_split)
     movable_tokens = right_split
 
     splitpoint = 0
-    best_splitpoint = 0
+    # Without a singable note, the left shard is kept whole instead of empty
+    best_splitpoint = 0 if movable_start else len(movable_tokens)
     while splitpoint <= len(movable_tokens):
-        left_candidate = left_note_shard + movable_tokens[:splitpoint]
-        right_candidate = movable_tokens[splitpoint:] + right_note_shard
-        if left_candidate[-1].endswith("\\time"): # '\time 12/8' -> += 2
+        candidate_end = movable_start + splitpoint
+        if candidate_end == 0: # An empty left shard is no split at all
+            splitpoint += 1
+            continue
+        last_token = left_note_shard[candidate_end - 1]
+        if last_token.text.endswith("\\time"): # '\time 12/8' -> += 2
             splitpoint += 2
             continue
-        if left_candidate[-1].endswith("\\key"): # '\key e \major' -> += 2
+        if last_token.text.endswith("\\key"): # '\key e \major' -> += 2
             splitpoint += 2
             continue
-        open_paranthesis = "".join(left_candidate).count('(')
-        open_paranthesis -= "".join(left_candidate).count(')')
-        ends_in_tie = left_candidate[-1].endswith('~')
+        if candidate_end < len(left_note_shard): # Blocks and arguments stay
+            following = left_note_shard[candidate_end] # with their command
+            if following.depth or following.kind in ("open", "word"):
+                splitpoint += 1
+                continue
+        open_paranthesis = opened[candidate_end] - closed[candidate_end]
+        ends_in_tie = last_token.tie
         if open_paranthesis == 0 and not ends_in_tie:
-            candidate_partial = calculate_new_partial(partial,
-                                                      time,
-                                                      " ".join(left_candidate))
-            if candidate_partial != None:
-                candidate_partial = decode_partial(candidate_partial)
+            candidate_partial = partial_after(candidate_end)
             if partial_metric(candidate_partial) <= partial_metric(best_partial):
                 best_partial = candidate_partial
                 best_splitpoint = splitpoint
         splitpoint += 1
 
-    left_note_shard = left_note_shard + movable_tokens[:best_splitpoint]
-    right_note_shard = movable_tokens[best_splitpoint:] + right_note_shard
-    left_note_shard = " ".join(left_note_shard)
-    right_note_shard = " ".join(right_note_shard)
-    new_left_partial = calculate_new_partial(partial, time, left_note_shard)
+    split_end = movable_start + best_splitpoint
+    new_left_partial = encode_partial(partial_after(split_end))
+    right_note_shard = left_note_shard[split_end:] + right_note_shard
+    left_note_shard = left_note_shard[:split_end]
     return left_note_shard, right_note_shard, new_left_partial
 
-def remove_lilypond_comments(string):
-    '''Remove all comments from a given string'''
-    string += '\n' # Last line workaround until $ matches the way it should.
-    string = ''.join(re.split("(?<!%)%{(?:.|\s)*?%}", string)) # multiline %{…%}
-    string = '\n'.join(re.split("%(?:.*?)\n", string)) # singleline %…\n
-    return string
-
 def create_normal_lyrics(lilypond_lyrics):
-    '''Form normal words from lilypond-tokenized lyrics.'''
-    lilypond_lyrics = remove_lilypond_comments(lilypond_lyrics)
+    '''Form normal words from lilypond-tokenized lyrics without comments.'''
     tokens = lilypond_lyrics.split()
     words = []
 
@@ -383,8 +800,7 @@ def is_singable_syllable(lilypond_lyric_piece):
     return  True
 
 def count_singable_lyrics(lilypond_lyrics):
-    '''Given a piece of lyrics, count how many syllables are sung in it.'''
-    lilypond_lyrics = remove_lilypond_comments(lilypond_lyrics)
+    '''Given a piece of lyrics without comments, count its sung syllables.'''
     tokens = lilypond_lyrics.split()
 
     syllable_counter = 0
@@ -410,14 +826,13 @@ def is_singable_note(lilypond_note, next_is_tie, open_parantheses):
         next_is_tie = True
     return is_singable, next_is_tie, open_parantheses
 
-def get_note_shards(lilypond_notes, lyric_shard_lengths):
+def get_note_shards(note_tokens, lyric_shard_lengths):
     '''Get the note shards corresponding to the given lyric shards.
 
+    The notes are given as Tokens, the shards are returned as lists of them.
+    A shard never starts inside a block, like the { } of a tuplet.
     All entries in lyric_shard_lengths must be strictly positive integers.
     '''
-    lilypond_notes = remove_lilypond_comments(lilypond_notes)
-    tokens = lilypond_notes.split()
-
     for x in lyric_shard_lengths:
         assert(x > 0)
     note_shards = []
@@ -425,10 +840,11 @@ def get_note_shards(lilypond_notes, lyric_shard_lengths):
     open_parantheses = 0
     next_is_tie = False
     singable_notes = 0
-    for t in tokens:
+    for t in note_tokens:
         is_singable, next_is_tie, open_parantheses = \
-                            is_singable_note(t, next_is_tie, open_parantheses)
-        if singable_notes >= lyric_shard_lengths[0] and is_singable:
+                        is_singable_note(t.text, next_is_tie, open_parantheses)
+        if singable_notes >= lyric_shard_lengths[0] and is_singable \
+                and t.depth == 0:
             singable_notes = 0
             note_shards += [current_shard]
             current_shard = []
@@ -438,7 +854,6 @@ def get_note_shards(lilypond_notes, lyric_shard_lengths):
             singable_notes += 1
     if current_shard != []:
         note_shards += [current_shard]
-    note_shards = [" ".join(shard) for shard in note_shards]
     return note_shards
 
 def create_absolute_notes(lilypond_notes, relative):
@@ -446,15 +861,24 @@ def create_absolute_notes(lilypond_notes, relative):
     if relative == "":
         raise ValueError("relative needs to be set")
     # Apparently, Christian speaks dutch…
-    lilypond_notes = remove_lilypond_comments(lilypond_notes)
-    parser = abjad.lilypondparsertools\
-                  .LilyPondParser(default_language='nederlands')
-    abj_notes = parser(r"\relative "
-                         + relative
-                         + r" { " + lilypond_notes + r" }")
-    normal_notes = abjad.LilyPondFormatManager.format_lilypond_value(abj_notes)
-    normal_notes = normal_notes.split('\n')
-    normal_notes = [n.strip() for n in normal_notes][1:-1] # '{' and '}'
+    lilypond_notes = remove_comments(lilypond_notes)
+    try:
+        normal_notes = relative_to_absolute(lilypond_notes, relative)
+    except ValueError: # Not one of the constructs understood without abjad
+        normal_notes = None
+    if normal_notes == None or cross_check:
+        import abjad
+        profiler.count("abjad absolute notes")
+        abj_notes = parse_lilypond(r"\relative "
+                                   + relative
+                                   + r" { " + lilypond_notes + r" }",
+                                   default_language='nederlands')
+        abjad_notes = abjad.LilyPondFormatManager\
+                           .format_lilypond_value(abj_notes)
+        abjad_notes = abjad_notes.split('\n')
+        abjad_notes = [n.strip() for n in abjad_notes][1:-1] # '{' and '}'
+        check_fast_path(normal_notes, abjad_notes, lilypond_notes)
+        normal_notes = abjad_notes
     normal_notes = " ".join(normal_notes)
     for match in re.findall(r"(R.)( ?\* ?)([0-9]+)", normal_notes):
         to_replace = match[0] + match[1] + match[2]
@@ -463,34 +887,465 @@ def create_absolute_notes(lilypond_notes, relative):
     normal_notes = normal_notes.replace('%%%', '')
     return normal_notes
 
-def main(source_file_name):
-    '''Run the thing.'''
-    clef_dict = {'bass':'bass',
-                 'tenor':'bass',
-                 'alto':'violin',
-                 'soprano':'violin'}
-    info = extract_information_from_source(source_file_name)
-    songtitle, global_options, relative, tempo, notes, lyrics, voice = info
-    tags = [songtitle, voice, 'physikerchor']
-    tags = [x.lower().replace(' ', '_') for x in tags]
-
+clef_dict = {'bass':'bass',
+             'tenor':'bass',
+             'alto':'violin',
+             'soprano':'violin'}
+
+Shard = collections.namedtuple('Shard', ['number', 'filename', 'notes',
+                                         'lyrics', 'global_options', 'tempo',
+                                         'clef'])
+
+async def render_mp3(tools, shard, workspace, cache=None,
+                     audio=default_audio):
+    """Render the .mp3 of a single shard.
+
+    With the numpy synthesizer, the notes are synthesized without any .midi.
+    Otherwise, the .midi is written by write_midi, only notes it doesn't
+    understand are left to lilypond. The .midi, or the filled template, is
+    named after the shard, so several shards can be rendered concurrently in
+    the same workspace.
+
+    tools -- the ToolScheduler to run the external tools with
+    shard -- a Shard holding everything needed to fill the template
+    workspace -- the Workspace to render in
+    cache -- a RenderCache to look up an already rendered .mp3 in
+    audio -- the AudioFormat to encode in
+    return -- the path of the .mp3
+    """
+    mp3_name = workspace.media_path(shard.filename)
+    with profiler.label(shard.filename):
+        notes, audio = read_synthesized_notes(shard.notes,
+                                              shard.global_options, audio)
+        if notes:
+            return await create_synthesized_mp3(tools, *notes, shard.tempo,
+                                                mp3_name, cache, audio)
+        try:
+            midi = write_midi(shard.notes, shard.global_options, shard.tempo)
+        except ValueError:
+            profiler.count("lilypond midis")
+        else:
+            return await create_mp3_from_midi(
+                                        tools, midi, mp3_name, cache, audio,
+                                        midi_name=workspace.path(
+                                                        shard.filename))
+        dot_ly_file_name = fill_template_mp3(
+                                        shard.notes,
+                                        out_file_name=workspace.path(
+                                                shard.filename + "_mp3"),
+                                        global_options=shard.global_options,
+                                        tempo=shard.tempo)
+        return await create_mp3(tools, dot_ly_file_name,
+                          mp3_name=mp3_name,
+                          remove_source=not workspace.keep,
+                          cache=cache,
+                          audio=audio)
+
+async def render_lilypond_pngs(tools, shard, workspace, cache=None,
+                               image=default_image):
+    """Typeset the .pngs of a single shard with lilypond alone.
+
+    tools -- the ToolScheduler to run the external tools with
+    shard -- a Shard holding everything needed to fill the template
+    workspace -- the Workspace to render in
+    cache -- a RenderCache to look up already rendered .pngs in
+    image -- the ImageFormat to write
+    return -- the paths of the .png and the .png without lyrics
+    """
+    png_name = workspace.media_path(shard.filename)
+    with profiler.label(shard.filename):
+        dot_ly_file_name = fill_template_lilypond_png(
+                                        shard.notes,
+                                        out_file_name=workspace.path(
+                                                shard.filename + "_png"),
+                                        lyrics=shard.lyrics,
+                                        global_options=shard.global_options,
+                                        clef=shard.clef)
+        return await create_lilypond_pngs(
+                                tools,
+                                dot_ly_file_name,
+                                png_name=png_name,
+                                tmp_folder=workspace.path(
+                                        tmp_folder + "_" + shard.filename),
+                                remove_source=not workspace.keep,
+                                cache=cache,
+                                image=image)
+
+def seconds_per_whole_note(tempo):
+    '''Given a lilypond tempo like '4=100', return the length of a 1 in s.'''
+    beat, beats_per_minute = tempo.split('=')
+    return 60 * int(beat) / int(beats_per_minute)
+
+async def render_song_mp3s(tools, shards, workspace, cache=None,
+                           audio=default_audio):
+    """Synthesize the whole voice once and cut it into one .mp3 per shard.
+
+    All shards are rendered as a single song, starting with the global options
+    of the first shard. The shards' start and end times follow from the
+    durations of their notes and the tempo. An anacrusis only moves the bar
+    lines, not the notes, so the first shard still starts at 0s. Like in
+    render_mp3, the song is synthesized by numpy if chosen, and lilypond only
+    writes the .midi if write_midi can't.
+
+    tools -- the ToolScheduler to run the external tools with
+    shards -- the Shards of a song, in order
+    workspace -- the Workspace to render in
+    cache -- a RenderCache to look up already rendered .mp3s in
+    audio -- the AudioFormat to synthesize and encode in
+    return -- the paths of the .mp3s, one per shard
+    """
+    song_name = shards[0].filename + "_song_mp3"
+    song_path = workspace.path(song_name)
+    with profiler.label(song_name):
+        song_notes = " ".join(s.notes for s in shards)
+        notes, audio = read_synthesized_notes(song_notes,
+                                              shards[0].global_options, audio)
+        midi = None
+        try:
+            if notes:
+                song_source = repr(notes + (shards[0].tempo,))
+            else:
+                midi = write_midi(song_notes, shards[0].global_options,
+                                  shards[0].tempo)
+                song_source = midi.hex()
+            song_tools = audio_tools(audio)
+        except ValueError:
+            profiler.count("lilypond midis")
+            fill_template_mp3(song_notes, out_file_name=song_path,
+                              global_options=shards[0].global_options,
+                              tempo=shards[0].tempo)
+            with open(song_path + ".ly") as source_file:
+                song_source = source_file.read()
+            song_tools = ["lilypond"] + audio_tools(audio)
+
+        # Cut on whole frames of 16 bit samples
+        frame_size = 2 * audio.channels
+        seconds = seconds_per_whole_note(shards[0].tempo)
+        boundaries = [0]
+        position = Fraction(0)
+        for shard in shards:
+            position += get_notes_duration(shard.notes)
+            boundaries += [round(position * seconds * audio.sample_rate)
+                           * frame_size]
+        boundaries[-1] = None # Keep the release of the last note
+
+        mp3_ids = []
+        to_render = []
+        for shard, start, end in zip(shards, boundaries, boundaries[1:]):
+            mp3_id = workspace.media_path(shard.filename
+                                          + audio_extension(audio))
+            mp3_ids += [mp3_id]
+            cache_key = None
+            if cache:
+                cache_key = cache.key(song_source, song_tools,
+                                      audio_flags(audio)
+                                      + ["slice", str(start), str(end)])
+                if cache.fetch(cache_key, audio_extension(audio), mp3_id):
+                    continue
+            to_render += [(mp3_id, start, end, cache_key)]
+
+        if to_render:
+            if notes:
+                pcm = await synthesize_with_numpy(tools, *notes,
+                                                  shards[0].tempo, audio)
+            else:
+                if midi == None:
+                    await tools.run(["lilypond", "-o", song_path,
+                                 song_path + ".ly"])
+                else:
+                    with open(song_path + ".midi", 'wb') as midi_file:
+                        midi_file.write(midi)
+                pcm = await synthesize_pcm(tools, song_path + ".midi", audio)
+                os.remove(song_path + ".midi")
+            import asyncio
+            await asyncio.gather(*[pcm_to_mp3(tools, pcm[start:end], mp3_id,
+                                              audio)
+                                   for mp3_id, start, end, _ in to_render])
+            for mp3_id, _, _, cache_key in to_render:
+                if cache:
+                    cache.store(cache_key, audio_extension(audio), mp3_id)
+        if midi == None and not notes and not workspace.keep:
+            os.remove(song_path + ".ly")
+        return mp3_ids
+
+def batch_png_fragments(shards, workspace, jobs=1):
+    """Split the .pngs of all shards into one batch per job for create_pngs.
+
+    return -- the fragments, .png paths, source and tmp folder of each batch,
+              all in the workspace
+    """
+    fragments = []
+    png_names = []
+    for shard in shards:
+        fragments += [fill_png_fragment(shard.notes,
+                                        lyrics=shard.lyrics,
+                                        global_options=shard.global_options,
+                                        clef=shard.clef),
+                      fill_png_fragment(shard.notes,
+                                        global_options=shard.global_options,
+                                        clef=shard.clef)]
+        png_names += [shard.filename, shard.filename + "_no_lyrics"]
+    batch_size = -(-len(fragments) // (jobs or os.cpu_count())) # Round up
+    batches = []
+    for start in range(0, len(fragments), batch_size):
+        batch_name = png_names[start] + "_batch"
+        batches += [(fragments[start:start + batch_size],
+                     [workspace.media_path(png_name) for png_name
+                      in png_names[start:start + batch_size]],
+                     workspace.path(batch_name),
+                     workspace.path(tmp_folder + "_" + batch_name))]
+    return batches
+
+async def render_concurrently(mp3_tasks, png_tasks):
+    """Run all render tasks at once, return the results of both kinds.
+
+    Once a task fails, or the run is interrupted, the others are cancelled and
+    waited for, so that no tools are left running.
+    """
+    if not mp3_tasks + png_tasks: # All media were restored
+        return [], []
+    import asyncio
+    tasks = [asyncio.ensure_future(task) for task in mp3_tasks + png_tasks]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel() # Does nothing to the finished ones
+        await asyncio.wait(tasks)
+    for task in tasks:
+        if not task.cancelled() and task.exception():
+            raise task.exception()
+    results = [task.result() for task in tasks]
+    return results[:len(mp3_tasks)], results[len(mp3_tasks):]
+
+def render_inputs(shard, audio_mode):
+    """Return what the .mp3 and what the .pngs of a shard are rendered from.
+
+    Shards with the same inputs get the same media. Slices of a song's audio
+    also depend on where they are cut, so in the "song" audio mode no two
+    shards have the same audio inputs. Notes and lyrics only differing in
+    their whitespace count as the same.
+    """
+    notes = collapse_whitespace(shard.notes)
+    mp3_inputs = (notes, shard.global_options, shard.tempo)
+    if audio_mode == "song":
+        mp3_inputs += (shard.number,)
+    return mp3_inputs, (notes, collapse_whitespace(shard.lyrics),
+                        shard.global_options, shard.clef)
+
+def share_restored(song, song_restored, audio_mode):
+    """Let identical shards of a song share the media restored for any of them.
+
+    render_shards names the media it renders for a group of identical shards
+    after the first one of them. Restored media of the same name, left by an
+    earlier build in which that shard was different, are dropped so that
+    they are rendered again as well.
+
+    song -- the Shards of a song, in order
+    song_restored -- per shard, the restored .mp3, .png and .png without
+                     lyrics, None for each one that has to be rendered
+    return -- song_restored, with shared media filled in and clashing ones
+              dropped
+    """
+    song_restored = [list(media) for media in song_restored]
+    for kind, kind_media in enumerate([slice(0, 1), slice(1, 3)]):
+        while True:
+            inputs = [render_inputs(shard, audio_mode)[kind] for shard in song]
+            available = {}
+            for shard_inputs, media in zip(inputs, song_restored):
+                if media[kind_media][0] is not None:
+                    available.setdefault(shard_inputs, media[kind_media])
+            rendered = {}
+            for shard, shard_inputs, media in zip(song, inputs, song_restored):
+                media[kind_media] = available.get(shard_inputs,
+                                                  media[kind_media])
+                if media[kind_media][0] is None:
+                    rendered.setdefault(shard_inputs, shard.filename)
+            clashing = [media[kind_media] for media in song_restored
+                        if media[kind_media][0] is not None
+                        and os.path.splitext(media[kind_media][0])[0]
+                            in rendered.values()]
+            if not clashing:
+                break
+            for media in song_restored:
+                if media[kind_media] in clashing:
+                    media[kind_media] = [None] * len(media[kind_media])
+    return [tuple(media) for media in song_restored]
+
+def render_shards(songs, workspace, jobs=1, cache=None, audio_mode="shard",
+                  png_backend="latex", restored=None, timeout=None,
+                  retries=0, audio=default_audio, image=default_image):
+    """Render the media of all shards of all songs.
+
+    The .mp3s are rendered shard by shard, or cut from a single rendering of
+    each song. With the latex backend, all .pngs, with and without lyrics,
+    are typeset in one batch per job, as most of their rendering time is spent
+    starting latex. The lilypond backend typesets both .pngs of a shard in a
+    single lilypond run instead. All shards and songs are rendered at once by
+    asyncio tasks, while each external tool runs at most jobs times at once.
+    That way the audio of one shard is rendered while another one's .pngs are
+    typeset. Identical shards of a song, like the verses of a repeated
+    refrain, are rendered once and share their media.
+
+    songs -- the Shards of each song, that is one voice of one file, in order
+    workspace -- the Workspace to render in, where the media are left
+    jobs -- number of concurrent runs of each tool, None for one per CPU core
+    cache -- a RenderCache to look up already rendered media in
+    audio_mode -- "shard" to synthesize each shard, "song" to synthesize once
+    png_backend -- "latex" to use lilypond-book, "lilypond" for lilypond only
+    restored -- per song and shard, the media kept from an earlier build, with
+                None for those to render
+    timeout -- seconds before a tool is killed, None for no limit
+    retries -- how often a failed or timed out tool is run again
+    audio -- the AudioFormat to encode the audio in
+    image -- the ImageFormat to write the scores in
+    return -- per song and shard, the names of the .mp3, the .png and the .png
+              without lyrics in the workspace
+    """
+    if restored is None:
+        restored = [[(None, None, None)] * len(song) for song in songs]
+    # Identical shards of a song share the media of the first one of them
+    all_shards = []
+    for song, song_restored in zip(songs, restored):
+        mp3_sources, png_sources = {}, {}
+        for shard, media in zip(song, song_restored):
+            mp3_inputs, png_inputs = render_inputs(shard, audio_mode)
+            mp3_source = png_source = None
+            if media[0] is None:
+                mp3_source = mp3_sources.setdefault(mp3_inputs, shard)
+            if media[1] is None:
+                png_source = png_sources.setdefault(png_inputs, shard)
+            all_shards += [(shard, media, mp3_source, png_source)]
+    shards = [shard for shard, _, source, _ in all_shards if source is shard]
+    png_shards = [shard for shard, _, _, source in all_shards
+                  if source is shard]
+    profiler.count("shared media", sum((mp3_source not in (None, shard))
+                                       + (png_source not in (None, shard))
+                                       for shard, _, mp3_source, png_source
+                                       in all_shards))
+    # A song's slices are cut from one rendering, so they are redone together
+    songs = [song for song, song_media in zip(songs, restored)
+             if any(media[0] is None for media in song_media)]
+    if audio_mode == "song":
+        shards = [shard for song in songs for shard in song]
+
+    import asyncio
+    from toolscheduler import ToolScheduler
+    tools = ToolScheduler(jobs, timeout, retries)
+    if png_backend == "lilypond":
+        png_tasks = [render_lilypond_pngs(tools, shard, workspace, cache,
+                                          image)
+                     for shard in png_shards]
+    elif png_shards:
+        png_tasks = [create_pngs(tools, *batch, cache=cache, image=image)
+                     for batch in batch_png_fragments(png_shards, workspace,
+                                                      jobs)]
+    else:
+        png_tasks = []
+    if audio_mode == "song":
+        mp3_tasks = [render_song_mp3s(tools, song, workspace, cache, audio)
+                     for song in songs]
+    else:
+        mp3_tasks = [render_mp3(tools, shard, workspace, cache, audio)
+                     for shard in shards]
+
+    mp3_ids, png_ids = asyncio.run(render_concurrently(mp3_tasks, png_tasks))
+    if audio_mode == "song":
+        mp3_ids = [mp3_id for song_ids in mp3_ids for mp3_id in song_ids]
+    png_ids = [png_id for task_ids in png_ids for png_id in task_ids]
+    # The media are named in the deck after their files in the workspace
+    mp3_ids = [os.path.basename(mp3_id) for mp3_id in mp3_ids]
+    png_ids = [os.path.basename(png_id) for png_id in png_ids]
+    mp3_ids = dict(zip([shard.filename for shard in shards], mp3_ids))
+    png_ids = dict(zip([shard.filename for shard in png_shards],
+                       zip(png_ids[0::2], png_ids[1::2])))
+
+    song_media = []
+    for song_restored in restored:
+        song_media += [[]]
+        for _, media, mp3_source, png_source \
+                in all_shards[:len(song_restored)]:
+            mp3_id = mp3_ids[mp3_source.filename] if mp3_source else media[0]
+            png_id, png_no_lyrics_id = (png_ids[png_source.filename]
+                                        if png_source else media[1:])
+            song_media[-1] += [(mp3_id, png_id, png_no_lyrics_id)]
+        all_shards = all_shards[len(song_restored):]
+    return song_media
+
+@functools.lru_cache(maxsize=64)
+def plan_shards(songtitle, global_options, tempo, relative, notes, lyrics,
+                voice, filename):
+    """Split a voice into shards along its lyrics, with the best note splits.
+
+    Every shard depends on the key, time and partial left behind by the
+    previous ones, so they are planned in order before anything is rendered.
+    Like parses, the plans of recent voices are remembered, so rebuilding a
+    file of which only one voice was edited doesn't plan the others again.
+
+    filename -- the start of the names of the shards' media
+    return -- the Shards of the voice, in order, as a tuple
+    """
     key, time, partial, options = extract_key_time_partial(global_options)
-    notes = create_absolute_notes(notes, relative)
-    lyric_shards = re.split("(?<!%)%{(?:.|\s)*?%}", lyrics)
+    with profiler.stage("absolute notes", filename):
+        notes = create_absolute_notes(notes, relative)
+    # Block comments split the shards, the other ones are removed right away
+    lyric_shards = [remove_comments(lyric_shard) for lyric_shard
+                    in re.split("(?<!%)%{(?:.|\s)*?%}", lyrics)]
     lyric_shard_lengths = [count_singable_lyrics(x) for x in lyric_shards]
     print("Generating note shards...", end='\r')
-    note_shards = get_note_shards(notes, lyric_shard_lengths)
+    with profiler.stage("note shards", filename):
+        note_shards = get_note_shards(lex_notes(notes), lyric_shard_lengths)
 
     print("Looking for best splits...", end='\r')
     tmp_partial = partial
     for i in range(1, len(note_shards)):
-        (note_shards[i-1],
-            note_shards[i],
-            tmp_partial) = find_best_split(tmp_partial,
-                                           time,
-                                           note_shards[i-1],
-                                           note_shards[i])
+        with profiler.stage("find_best_split",
+                            filename + "_{:003n}".format(i - 1)):
+            (note_shards[i-1],
+                note_shards[i],
+                tmp_partial) = find_best_split(tmp_partial,
+                                               time,
+                                               note_shards[i-1],
+                                               note_shards[i])
+
+    shards = []
+    for shard_num, answr_lyrics in enumerate(lyric_shards):
+        answr_tokens = note_shards[shard_num]
+        answr_notes = " ".join(token.text for token in answr_tokens)
+        answ_options = r"\key {} \time {} {}".format(key, time, options)
+        if partial:
+            answ_options += r" \partial {}".format(partial)
+
+        shard_filename = filename + "_{:003n}".format(shard_num)
+        shards += [Shard(shard_num, shard_filename, answr_notes, answr_lyrics,
+                         answ_options, tempo, clef_dict[voice])]
+
+        # Find out if there was a change in time, key, or partial
+        new_key, new_time, _, _ = extract_key_time_partial(answr_notes)
+        if new_key:
+            key = new_key
+        if new_time:
+            time = new_time
+        partial = calculate_token_partial(partial, time, answr_tokens)
+    return tuple(shards)
+
+def write_deck(songtitle, voice, shards, media, deck_file_name, workspace,
+               restored=()):
+    """Turn the rendered shards of a voice into notes and export the deck.
+
+    shards -- the Shards of the voice, in order
+    media -- per shard, the .mp3, the .png and the .png without lyrics
+    deck_file_name -- where to write the .apkg
+    workspace -- the Workspace the media were rendered in
+    restored -- the names of the media to take from the previous .apkg at
+                deck_file_name, instead of the working directory
+    """
+    tags = [songtitle, voice, 'physikerchor']
+    tags = [x.lower().replace(' ', '_') for x in tags]
 
+    import genanki
+    from ankipackage import write_package
+    from choirnote import ChoirNote, embed_picture, embed_mp3
     print("Starting note generation...", end='\r')
     anki_deck = genanki.Deck(1452737122, 'Physikerchor') # random but hardcoded
     anki_media = []
@@ -501,34 +1356,11 @@ def main(source_file_name):
     qustn_lyrics = ''
     qustn_mp3_id = ''
     feedback = 'Completed note {:003} of {:003}...'
-    for shard_num, answr_lyrics in enumerate(lyric_shards):
-        # First up, generate the 'answr' shard, which will be the answer…
-        answr_notes = note_shards[shard_num]
-        answ_options = r"\key {} \time {} {}".format(key, time, options)
-        if partial:
-            answ_options += r" \partial {}".format(partial)
-
-        filename = songtitle.replace(' ', '_').lower()
-        filename += "_{:003n}".format(shard_num)
-        dot_ly_file_name = fill_template_mp3(answr_notes,
-                                             global_options=answ_options,
-                                             tempo=tempo)
-        answr_mp3_id = create_mp3(dot_ly_file_name,
-                                  mp3_name=filename,
-                                  remove_source=True)
-        dot_ly_file_name = fill_template_png(answr_notes,
-                                             global_options=answ_options,
-                                             clef=clef_dict[voice],
-                                             lyrics=answr_lyrics)
-        answr_png_id = create_png(dot_ly_file_name,
-                                  png_name=filename,
-                                  remove_source=True)
-        dot_ly_file_name = fill_template_png(answr_notes,
-                                             global_options=answ_options,
-                                             clef=clef_dict[voice])
-        answr_png_no_lyrics_id = create_png(dot_ly_file_name,
-                                            png_name=filename + "_no_lyrics",
-                                            remove_source=True)
+    for shard, shard_media in zip(shards, media):
+        # First up, the rendered 'answr' shard will be the answer…
+        answr_mp3_id, answr_png_id, answr_png_no_lyrics_id = shard_media
+        shard_num = shard.number
+        answr_lyrics = shard.lyrics
 
         # …then, fill the note with both 'qustn' shard and the 'answr' shard…
         anki_media += [answr_mp3_id, answr_png_id, answr_png_no_lyrics_id]
@@ -546,17 +1378,10 @@ def main(source_file_name):
                                       embed_picture(answr_png_no_lyrics_id),
                                       create_normal_lyrics(answr_lyrics),
                                       embed_mp3(answr_mp3_id)],
-                              tags=tags)
+                              tags=tags,
+                              voice=voice)
         anki_deck.add_note(anki_note)
 
-        # …find out if there was a change in time, key, or partial…
-        new_key, new_time, _, _ = extract_key_time_partial(answr_notes)
-        if new_key:
-            key = new_key
-        if new_time:
-            time = new_time
-        partial = calculate_new_partial(partial, time, answr_notes)
-
         # …cache the 'answr' shard, so it can become the next question.
         qustn_png_id = answr_png_id
         qustn_png_no_lyrics_id = answr_png_no_lyrics_id
@@ -565,17 +1390,349 @@ def main(source_file_name):
         is_first_part = ''
 
         # Give a little feedback
-        print(feedback.format(shard_num + 1, len(lyric_shards)), end='\r')
-
-    # Export the deck
-    anki_package = genanki.Package(anki_deck, media_files=anki_media)
-    anki_package.write_to_file(songtitle + '.apkg')
-    for file in anki_media: # All files are now inside the apkg
-        os.remove(file)
-    print('Successfully generated ' + songtitle + '.apkg')
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("filename", help="lilypond file to parse")
+        print(feedback.format(shard_num + 1, len(shards)), end='\r')
+
+    # Export the deck, restored media come straight from the previous one
+    anki_media = list(dict.fromkeys(anki_media)) # Identical shards share media
+    rendered_media = [name for name in anki_media if name not in restored]
+    with contextlib.ExitStack() as stack:
+        media_contents = {name: workspace.media_path(name)
+                          for name in rendered_media}
+        if restored:
+            previous = stack.enter_context(zipfile.ZipFile(deck_file_name))
+            archived = archived_media(previous)
+            for name in restored:
+                media_contents[name] = functools.partial(previous.open,
+                                                         archived[name])
+        with profiler.stage("write apkg", deck_file_name):
+            write_package(anki_deck,
+                          [(name, media_contents[name]) for name in anki_media],
+                          deck_file_name)
+    print('Successfully generated ' + deck_file_name)
+
+def find_sources(paths):
+    """Expand directories among paths into the .ly files inside them.
+
+    A file given more than once, also as part of a directory, is only built
+    once.
+    """
+    source_file_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            source_file_names += sorted(os.path.join(path, name)
+                                        for name in os.listdir(path)
+                                        if name.endswith(".ly"))
+        else:
+            source_file_names += [path]
+    unique_file_names = []
+    seen = set()
+    for source_file_name in source_file_names:
+        if os.path.realpath(source_file_name) not in seen:
+            seen.add(os.path.realpath(source_file_name))
+            unique_file_names += [source_file_name]
+    return unique_file_names
+
+def main(source_file_names, voices=('bass',), jobs=1, cache=None,
+         audio_mode="shard", png_backend="latex", incremental=True,
+         timeout=None, retries=0, audio=default_audio,
+         image=default_image, workspace_root=None, keep_intermediates=False):
+    """Run the thing.
+
+    Each source is parsed once for all voices, and the media of all songs are
+    rendered together in a Workspace. There is one deck per source and voice,
+    named after the song and, unless it is the bass alone, the voice.
+    Songs of the same title are told apart by the names of their sources, in
+    the names of their decks and media as well as in the titles of their
+    notes, which their GUIDs are made from.
+    Only the decks and their manifests are written to the working directory.
+
+    source_file_names -- the lilypond files to turn into decks
+    voices -- the voices to extract from each file, keys of clef_dict
+    jobs -- number of concurrent runs of each tool, None for one per CPU core
+    cache -- a RenderCache to look up already rendered media in
+    audio_mode -- "shard" to synthesize each shard, "song" to synthesize once
+    png_backend -- "latex" to use lilypond-book, "lilypond" for lilypond only
+    incremental -- whether to keep the media of unchanged shards from the
+                   previous build of each deck
+    timeout -- seconds before a tool is killed, None for no limit
+    retries -- how often a failed or timed out tool is run again
+    audio -- the AudioFormat to encode the audio in
+    image -- the ImageFormat to write the scores in
+    workspace_root -- where to make the Workspace's intermediate files, None
+                      for /dev/shm or the temp directory
+    keep_intermediates -- keep the Workspace after the build, to debug it
+    return -- the paths of the written decks
+    """
+    decks = []
+    songs = []
+    named_sources = {} # The source each name of media and decks is taken by
+    for source_file_name in source_file_names:
+        with profiler.stage("extract voices", source_file_name):
+            info = extract_voices_from_source(source_file_name, voices)
+        songtitle, global_options, tempo, voice_information = info
+        song_name = songtitle.replace(' ', '_').lower()
+        deck_title = songtitle
+        if song_name in named_sources:
+            # The media of both songs would share their names
+            source_name = os.path.splitext(
+                                    os.path.basename(source_file_name))[0]
+            song_name += "_" + source_name.replace(' ', '_').lower()
+            deck_title = "{} ({})".format(songtitle, source_name)
+        if song_name in named_sources:
+            raise ValueError("{} and {} would both be built into the deck "
+                             "{}".format(named_sources[song_name],
+                                         source_file_name, deck_title))
+        named_sources[song_name] = source_file_name
+        for voice in voices:
+            if voice not in voice_information:
+                print("No {} in {}, skipping it".format(voice,
+                                                        source_file_name))
+                continue
+            relative, notes, lyrics = voice_information[voice]
+            filename = song_name
+            deck_file_name = deck_title + '.apkg'
+            # Like the GUIDs of the notes, only a lone bass goes without its
+            # voice, so that other voices don't overwrite the bass deck
+            if len(voices) > 1 or voice != 'bass':
+                filename += "_" + voice
+                deck_file_name = "{} ({}).apkg".format(deck_title, voice)
+            shards = plan_shards(songtitle, global_options, tempo, relative,
+                                 notes, lyrics, voice, filename)
+            songs += [shards]
+            decks += [(deck_title, voice, deck_file_name,
+                       shard_hashes(shards, audio_mode, png_backend,
+                                    audio_flags(audio), image_flags(image)))]
+
+    restored = [[(None, None, None)] * len(song) for song in songs]
+    if incremental:
+        with profiler.stage("restore media"):
+            restored = [restore_media(deck_file_name, hashes)
+                        for _, _, deck_file_name, hashes in decks]
+        if audio_mode == "song": # Slices of a song are rendered together
+            restored = [[(None,) + media[1:] for media in song_media]
+                        if any(media[0] == None for media in song_media)
+                        else song_media
+                        for song_media in restored]
+        restored = [share_restored(song, song_media, audio_mode)
+                    for song, song_media in zip(songs, restored)]
+        profiler.count("restored media", sum(media != None
+                                             for song_media in restored
+                                             for shard_media in song_media
+                                             for media in shard_media))
+
+    with Workspace(workspace_root, keep_intermediates) as workspace:
+        print("Rendering media...", end='\r')
+        with profiler.stage("render"):
+            media = render_shards(songs, workspace, jobs, cache, audio_mode,
+                                  png_backend, restored, timeout, retries,
+                                  audio, image)
+        if cache:
+            with profiler.stage("evict cache"):
+                cache.evict()
+
+        for deck, shards, song_media, song_restored in zip(decks, songs,
+                                                           media, restored):
+            songtitle, voice, deck_file_name, hashes = deck
+            restored_names = set(name for shard_media in song_restored
+                                      for name in shard_media if name != None)
+            write_deck(songtitle, voice, shards, song_media, deck_file_name,
+                       workspace, restored_names)
+            write_manifest(deck_file_name, hashes, song_media)
+    return [os.path.abspath(deck_file_name)
+            for _, _, deck_file_name, _ in decks]
+
+def run_job(arguments):
+    """Build the decks asked for on the command line, or by a daemon's client.
+
+    arguments -- the parsed command line arguments, as a dict
+    return -- the paths of the written decks
+    """
+    global cross_check
+    cross_check = arguments["cross_check"]
+    tool_fingerprint.cache_clear() # Tools may be upgraded while serving
+    cache = None
+    if not arguments["no_cache"]:
+        cache = RenderCache(arguments["cache_dir"],
+                            arguments["cache_size"] * 1024**2)
+    voices = arguments["voice"] or ['bass']
+    if "all" in voices:
+        voices = list(clef_dict)
+    voices = list(collections.OrderedDict.fromkeys(voices)) # Drop repeats
+    return main(find_sources(arguments["filenames"]), voices=voices,
+                jobs=arguments["jobs"] or None, cache=cache,
+                audio_mode=arguments["audio_mode"],
+                png_backend=arguments["png_backend"],
+                incremental=not arguments["full_rebuild"],
+                timeout=arguments["timeout"] or None,
+                retries=arguments["retries"],
+                audio=AudioFormat(arguments["audio_format"],
+                                  arguments["bitrate"] or None,
+                                  arguments["sample_rate"],
+                                  1 if arguments["mono"] else 2,
+                                  arguments["audio_backend"],
+                                  arguments["timbre"]),
+                image=ImageFormat(arguments["image_format"],
+                                  arguments["resolution"] or None,
+                                  arguments["png_colors"]),
+                workspace_root=arguments["workspace"],
+                keep_intermediates=arguments["keep_intermediates"])
+
+if __name__ == "__main__" and sys.argv[1:2] == ["serve"]:
+    parser = argparse.ArgumentParser(
+                        prog="choir2anki.py serve",
+                        description="keep choir2anki loaded and build decks "
+                                    "for clients connecting to a socket")
+    parser.add_argument("--socket", default=default_socket_path,
+                        help="where to listen (default: %(default)s)")
+    args = parser.parse_args(sys.argv[2:])
+    serve(run_job, args.socket)
+elif __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                        epilog="Run 'choir2anki.py serve' to keep a daemon "
+                             "running, later runs will then hand their work "
+                             "to it.")
+    parser.add_argument("filenames", nargs="+", metavar="filename",
+                        help="lilypond file to parse, or a directory of them")
+    parser.add_argument("-v", "--voice", action="append",
+                        choices=list(clef_dict) + ["all"],
+                        help="voice to make a deck of, may be given more than "
+                             "once, 'all' for every voice (default: bass)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of concurrent runs of each external "
+                             "tool, 0 for one per CPU core (default: 1)")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="seconds before an external tool is killed, 0 "
+                             "for no limit (default: %(default)s)")
+    parser.add_argument("--retries", type=int, default=1,
+                        help="how often a failed or timed out external tool "
+                             "is run again (default: %(default)s)")
+    parser.add_argument("--audio-mode", choices=["shard", "song"],
+                        default="shard",
+                        help="synthesize the audio of every shard on its own, "
+                             "or the whole song once and cut it into shards "
+                             "(default: %(default)s)")
+    parser.add_argument("--audio-format", choices=list(audio_codecs),
+                        default=default_audio.codec,
+                        help="encode the audio as mp3 with lame, ogg vorbis "
+                             "with oggenc or opus with opusenc (default: "
+                             "%(default)s)")
+    parser.add_argument("--bitrate", type=int, default=0, metavar="KBPS",
+                        help="bitrate of the audio in kbit/s, 0 for the "
+                             "encoder's default (default: %(default)s)")
+    parser.add_argument("--sample-rate", type=int,
+                        default=default_audio.sample_rate, metavar="HZ",
+                        help="samples per second timidity synthesizes, like "
+                             "22050 for smaller files (default: %(default)s)")
+    parser.add_argument("--mono", action="store_true",
+                        help="synthesize and encode the audio in mono, which "
+                             "is all a single voice needs")
+    parser.add_argument("--audio-backend", choices=["timidity", "numpy"],
+                        default=default_audio.synthesizer,
+                        help="synthesize the audio with timidity, or in "
+                             "process with numpy, which is faster and needs "
+                             "no timidity (default: %(default)s)")
+    parser.add_argument("--timbre", choices=list(timbres),
+                        default=default_audio.timbre,
+                        help="what the numpy synthesizer sounds like "
+                             "(default: %(default)s)")
+    parser.add_argument("--png-backend", choices=["latex", "lilypond"],
+                        default="latex",
+                        help="typeset the scores with lilypond-book, latex and "
+                             "dvipng, or with lilypond alone (default: "
+                             "%(default)s)")
+    parser.add_argument("--image-format", choices=["png", "svg"],
+                        default=default_image.format,
+                        help="write the scores as .pngs, or as .svgs that "
+                             "stay sharp at any size, with dvisvgm instead "
+                             "of dvipng for the latex backend (default: "
+                             "%(default)s)")
+    parser.add_argument("--resolution", type=int, default=0, metavar="DPI",
+                        help="dots per inch of the .pngs, 0 for the tools' "
+                             "default (default: %(default)s)")
+    parser.add_argument("--png-colors", choices=["full", "grey", "mono"],
+                        default=default_image.colors,
+                        help="colors of the .pngs: as the tools write them, "
+                             "antialiased greys in one channel or a palette, "
+                             "or black and white at one bit per pixel "
+                             "(default: %(default)s)")
+    parser.add_argument("--cache-dir", default=default_cache_dir,
+                        help="where to keep rendered media between runs "
+                             "(default: %(default)s)")
+    parser.add_argument("--cache-size", type=int,
+                        default=default_max_size // 1024**2,
+                        help="size limit of the cache in MiB, least recently "
+                             "used media is evicted first (default: "
+                             "%(default)s)")
+    parser.add_argument("--workspace", metavar="DIR",
+                        help="where to make the directory for intermediate "
+                             "files (default: /dev/shm, else the temp "
+                             "directory)")
+    parser.add_argument("--keep-intermediates", action="store_true",
+                        help="keep the directory of intermediate files after "
+                             "the build, for debugging")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always render all media from scratch")
+    parser.add_argument("--full-rebuild", action="store_true",
+                        help="render the media of all shards, even those "
+                             "unchanged since the deck was last built")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and rebuild the decks whenever "
+                             "a source is saved, rendering only the shards "
+                             "that changed")
+    parser.add_argument("--profile", metavar="REPORT",
+                        help="time every stage and external tool, write a "
+                             "JSON report to REPORT and print a summary")
+    parser.add_argument("--profile-python", metavar="STATS",
+                        help="profile the python side with cProfile and write "
+                             "the stats to STATS, for use with pstats")
+    parser.add_argument("--cross-check", action="store_true",
+                        help="verify the abjad-free handling of notes against "
+                             "abjad, failing on any difference")
+    parser.add_argument("--socket", default=default_socket_path,
+                        help="where to look for a daemon (default: "
+                             "%(default)s)")
+    parser.add_argument("--no-daemon", action="store_true",
+                        help="build here, even if a daemon is running")
     args = parser.parse_args()
-    main(args.filename)
+    arguments = vars(args)
+
+    # Profiling and watching are about this process, so they never go to a
+    # daemon
+    if not (args.no_daemon or args.watch or args.profile
+            or args.profile_python):
+        try:
+            submit_job(arguments, args.socket)
+            sys.exit()
+        except RuntimeError as error: # The job failed in the daemon
+            sys.exit(str(error))
+        except OSError: # No daemon, build here
+            pass
+
+    profiler.enabled = args.profile != None
+    run = functools.partial(run_job, arguments)
+
+    def build():
+        start = time.perf_counter()
+        parse_hits = parse_lilypond.cache_info().hits
+        plan_hits = plan_shards.cache_info().hits
+        if args.profile_python:
+            import cProfile
+            python_profile = cProfile.Profile()
+            python_profile.runcall(run)
+            python_profile.dump_stats(args.profile_python)
+        else:
+            run()
+        if args.profile:
+            profiler.count("parse cache hits",
+                           parse_lilypond.cache_info().hits - parse_hits)
+            profiler.count("plan cache hits",
+                           plan_shards.cache_info().hits - plan_hits)
+            print(profiler.write_report(args.profile,
+                                        time.perf_counter() - start))
+            profiler.collect() # Each build of --watch gets its own report
+
+    if args.watch:
+        from sourcewatcher import watch
+        watch(build, functools.partial(find_sources, args.filenames))
+    else:
+        build()
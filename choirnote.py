@@ -14,9 +14,7 @@ mp3_template = r'''
 }
 '''
 
-png_template = r'''
-\documentclass{standalone}
-\begin{document}
+png_fragment_template = r'''
 \begin{lilypond}
   \language "english"
   \layout {
@@ -39,9 +37,56 @@ png_template = r'''
   >>
 \layout{}
 \end{lilypond}
+'''
+
+# Every standalone environment ends up cropped on a page of its own
+png_batch_template = r'''
+\documentclass[multi=true]{standalone}
+\begin{document}
+${fragments}
 \end{document}
 '''
 
+# Typeset without latex: each \book is written to its own cropped image
+png_lilypond_template = r'''
+\version "2.18.2"
+\language "english"
+\layout {
+  indent = #0
+  line-width = #50000
+}
+music = {
+  ${global_options}
+  \clef ${clef}
+  \absolute {
+    ${notes}
+  }
+}
+\book {
+  \bookOutputSuffix "lyrics"
+  \score {
+    \new Staff = "s" <<
+      \new Voice = "b" { \music }
+      \new Lyrics \lyricsto "b" <<
+        \lyricmode {
+          ${lyrics}
+        }
+      >>
+    >>
+    \layout{}
+  }
+}
+\book {
+  \bookOutputSuffix "no_lyrics"
+  \score {
+    \new Staff = "s" <<
+      \new Voice = "b" { \music }
+    >>
+    \layout{}
+  }
+}
+'''
+
 def embed_picture(picture_location):
   if picture_location == "":
     return ""
@@ -53,6 +98,10 @@ def embed_mp3(mp3_location):
   return '[sound:{}]'.format(mp3_location)
 
 class ChoirNote(genanki.Note):
+    def __init__(self, *args, voice='bass', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.voice = voice
+
     def choir_model():
         model_id = '1544216877' # random string, hardcoded
         model_name = 'choir_model'
@@ -144,4 +193,7 @@ class ChoirNote(genanki.Note):
     @property
     def guid(self):
         # Don't hash random strings, only identifier: songtitle & part_number
-        return genanki.guid_for(self.fields[1], self.fields[2])
+        # The bass came first, so only the other voices add theirs
+        if self.voice == 'bass':
+            return genanki.guid_for(self.fields[1], self.fields[2])
+        return genanki.guid_for(self.fields[1], self.fields[2], self.voice)
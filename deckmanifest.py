@@ -0,0 +1,114 @@
+"""
+A manifest of the shards a deck was built from, for incremental rebuilds.
+
+Next to each .apkg, the manifest records for every shard a hash of what its
+audio and its scores were rendered from, and the names of the media this gave.
+When the deck is rebuilt, the media of shards whose hashes didn't change are
+taken over from the previous .apkg instead of being rendered again.
+"""
+
+import hashlib
+import json
+import os
+import zipfile
+
+def manifest_file_name(deck_file_name):
+    '''Return where the manifest of a deck is kept.'''
+    return os.path.splitext(deck_file_name)[0] + ".manifest.json"
+
+def hash_parts(parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def collapse_whitespace(text):
+    '''Collapse the runs of whitespace in text, which lilypond reads as one.'''
+    return " ".join(text.split())
+
+def shard_hashes(shards, audio_mode, png_backend, audio_flags=(),
+                 image_flags=()):
+    """Hash what the audio and the scores of each shard depend on.
+
+    When the audio is cut from a rendering of the whole song, each slice
+    depends on all of the song's notes, not only those of its shard. The
+    whitespace around notes and lyrics changes nothing rendered from them.
+
+    shards -- the Shards of a song, in order
+    audio_mode -- "shard" or "song", as given to render_shards
+    png_backend -- "latex" or "lilypond", as given to render_shards
+    audio_flags -- anything else the audio depends on, like the command lines
+                   of the synthesizer and the encoder
+    image_flags -- anything else the scores depend on, like the command lines
+                   of the typesetting tools
+    return -- per shard, the hash of its .mp3 and of its .pngs
+    """
+    hashes = []
+    for shard in shards:
+        if audio_mode == "song":
+            mp3_parts = ([collapse_whitespace(s.notes) for s in shards]
+                         + [shards[0].global_options, shards[0].tempo,
+                            "song", str(shard.number)])
+        else:
+            mp3_parts = [collapse_whitespace(shard.notes),
+                         shard.global_options, shard.tempo]
+        png_parts = [collapse_whitespace(shard.notes),
+                     collapse_whitespace(shard.lyrics), shard.global_options,
+                     shard.clef, png_backend]
+        hashes += [(hash_parts(mp3_parts + list(audio_flags)),
+                    hash_parts(png_parts + list(image_flags)))]
+    return hashes
+
+def archived_media(package):
+    '''Map the names of the media in an open .apkg to their zip members.'''
+    media_names = json.loads(package.read("media").decode())
+    return {name: index for index, name in media_names.items()}
+
+def restore_media(deck_file_name, hashes):
+    """Find the media of unchanged shards in the previous build of a deck.
+
+    The media stay inside the .apkg, until write_deck copies them over.
+
+    deck_file_name -- the .apkg written by the previous build
+    hashes -- per shard, the hash of its .mp3 and of its .pngs
+    return -- per shard, the restored .mp3, .png and .png without lyrics,
+              None for each one that has to be rendered again
+    """
+    restored = [(None, None, None)] * len(hashes)
+    try:
+        with open(manifest_file_name(deck_file_name)) as manifest_file:
+            manifest = json.load(manifest_file)
+        package = zipfile.ZipFile(deck_file_name)
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return restored # Nothing to start from, render everything
+
+    with package:
+        archived = archived_media(package)
+    for number, (mp3_hash, png_hash) in enumerate(hashes):
+        if number >= len(manifest["shards"]):
+            break
+        entry = manifest["shards"][number]
+        mp3_id = png_ids = None
+        if entry["mp3_hash"] == mp3_hash and entry["mp3"] in archived:
+            mp3_id = entry["mp3"]
+        if entry["png_hash"] == png_hash and entry["png"] in archived \
+                and entry["png_no_lyrics"] in archived:
+            png_ids = entry["png"], entry["png_no_lyrics"]
+        restored[number] = (mp3_id,) + (png_ids or (None, None))
+    return restored
+
+def write_manifest(deck_file_name, hashes, media):
+    """Record the hashes and media of all shards of a freshly written deck.
+
+    hashes -- per shard, the hash of its .mp3 and of its .pngs
+    media -- per shard, the .mp3, the .png and the .png without lyrics
+    """
+    shards = []
+    for (mp3_hash, png_hash), (mp3_id, png_id, png_no_lyrics_id) \
+            in zip(hashes, media):
+        shards += [{"mp3_hash": mp3_hash, "mp3": mp3_id,
+                    "png_hash": png_hash, "png": png_id,
+                    "png_no_lyrics": png_no_lyrics_id}]
+    with open(manifest_file_name(deck_file_name), 'w') as manifest_file:
+        json.dump({"shards": shards}, manifest_file, indent=1)
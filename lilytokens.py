@@ -0,0 +1,455 @@
+"""
+Fast handling of the lilypond notes choir2anki works on, without abjad.
+
+The notes of a voice, and even more so the absolute notes formatted by abjad,
+only use a small part of the lilypond syntax. For those, durations can be read
+off token by token and \\relative notes can be made absolute in a single pass.
+Whenever something isn't understood, a ValueError is raised so the caller can
+fall back to abjad.
+"""
+
+import collections
+from fractions import Fraction
+import re
+
+note_pattern = re.compile(r"(?:[a-g][a-z]*[',]*[!?]?|[rsR])(\d*)(\.*)([~()]*)$")
+chord_end_pattern = re.compile(r"[^>]*>(\d*)(\.*)([~()]*)$")
+multiplier_pattern = re.compile(r"(\d+)(?:/(\d+))?$")
+
+def parse_duration(digits, dots):
+    '''Turn lilypond duration digits and dots like '4', '..' into a Fraction.'''
+    duration = Fraction(1, int(digits))
+    return duration * (2 - Fraction(1, 2**len(dots)))
+
+def get_token_durations(tokens):
+    '''Return the duration of every token and the \\time changes among them.
+
+    Notes without a duration get the one of the note before, just like in
+    lilypond. A multiplier like 'R1 * 3' adds its extra duration to the
+    token holding the factor. The \\time changes are given as pairs of the
+    position of the '\\time' token and the new time signature.
+    '''
+    durations = []
+    time_changes = []
+    last_duration = Fraction(1, 4)
+    last_event = Fraction(0)
+    in_chord = False
+    skip = 0
+    for position, token in enumerate(tokens):
+        duration = Fraction(0)
+        if skip:
+            skip -= 1
+        elif token == "\\time":
+            if position + 1 < len(tokens):
+                time_changes += [(position, tokens[position + 1])]
+            skip = 1
+        elif token == "\\key":
+            skip = 2
+        elif token in ("~", "(", ")", "[", "]", "|", "*"):
+            pass
+        elif in_chord or token.startswith('<'):
+            match = chord_end_pattern.match(token.lstrip('<'))
+            in_chord = match == None
+            if not in_chord:
+                if match[1]:
+                    last_duration = parse_duration(match[1], match[2])
+                duration = last_event = last_duration
+        elif position > 0 and tokens[position - 1] == "*":
+            match = multiplier_pattern.match(token)
+            if match == None:
+                raise ValueError("unknown multiplier " + token)
+            factor = Fraction(int(match[1]), int(match[2] or 1))
+            duration = last_event * (factor - 1)
+        else:
+            match = note_pattern.match(token)
+            if match == None:
+                raise ValueError("unknown token " + token)
+            if match[1]:
+                last_duration = parse_duration(match[1], match[2])
+            duration = last_event = last_duration
+        durations += [duration]
+    if in_chord:
+        raise ValueError("unterminated chord")
+    return durations, time_changes
+
+# A whitespace separated piece of notes found by lex_notes, with its offset in
+# the notes, its kind, how many {} and <<>> blocks are open where it starts,
+# its duration (None if it isn't understood), whether it ends in a tie and how
+# many slurs it opens and closes
+Token = collections.namedtuple('Token', ['text', 'offset', 'kind', 'depth',
+                                         'duration', 'tie', 'slur_opens',
+                                         'slur_closes'])
+
+comment_pattern = r"%\{.*?%\}|%[^\n]*"
+lexer_pattern = re.compile(comment_pattern + r"|[^\s%]+", re.DOTALL)
+
+def remove_comments(string):
+    '''Remove all comments from a string, leaving its line breaks.'''
+    return re.sub(comment_pattern, "", string, flags=re.DOTALL)
+
+def token_kind(text):
+    '''Return the kind of a token of notes, like 'note' or 'command'.
+
+    Notes, rests and the pieces of chords are 'note's, ties, slurs, beams,
+    bar checks and multiplications 'symbol's. Blocks start with an 'open'
+    token and end with a 'close' one. Anything else, like the arguments of
+    commands, is a 'word'.
+    '''
+    if text in ("{", "<<"):
+        return "open"
+    if text in ("}", ">>"):
+        return "close"
+    if text.startswith("\\"):
+        return "command"
+    if text in ("~", "(", ")", "[", "]", "|", "*"):
+        return "symbol"
+    if note_pattern.match(text) or chord_end_pattern.match(text) \
+            or text.startswith('<'):
+        return "note"
+    return "word"
+
+def lex_notes(notes):
+    """Split notes into Tokens in a single pass, skipping comments.
+
+    The durations are those of get_token_durations. If any token isn't
+    understood, all durations are None, so the caller can fall back to abjad.
+    """
+    matches = [m for m in lexer_pattern.finditer(notes) if m[0][0] != '%']
+    try:
+        durations = get_token_durations([m[0] for m in matches])[0]
+    except ValueError:
+        durations = [None] * len(matches)
+    tokens = []
+    depth = 0
+    for m, duration in zip(matches, durations):
+        tokens += [Token(m[0], m.start(), token_kind(m[0]), depth, duration,
+                         m[0].endswith('~'), m[0].count('('),
+                         m[0].count(')'))]
+        depth += m[0].count('{') + m[0].count('<<') - m[0].count('}') \
+                 - m[0].count('>>')
+    return tokens
+
+class DurationIndex:
+    """The durations of all prefixes of a list of Tokens.
+
+    Building the index reads each token once. Afterwards, the partial left
+    after any prefix is found without looking at the tokens again.
+    """
+
+    def __init__(self, tokens):
+        if any(token.duration == None for token in tokens):
+            raise ValueError("unknown durations")
+        self.time_changes = [(position, tokens[position + 1].text)
+                             for position, token in enumerate(tokens[:-1])
+                             if token.text == "\\time"]
+        self.prefix_durations = [Fraction(0)]
+        for token in tokens:
+            self.prefix_durations += [self.prefix_durations[-1]
+                                      + token.duration]
+
+    def get_partial(self, end, partial, time):
+        '''Return how much of the last measure is left after tokens[:end].
+
+        This mirrors calculate_new_partial: after a change in \\time, only the
+        notes following the last change count and the partial is dropped. If
+        the change is the very last thing, the one before it is used instead.
+
+        end -- the length of the prefix
+        partial -- the incoming partial as a Fraction, or None
+        time -- the incoming time signature, like '4/4'
+        return -- the missing duration as a Fraction, None if complete
+        '''
+        changes = [c for c in self.time_changes if c[0] + 1 < end]
+        start = 0
+        if changes:
+            partial = None
+            position, time = changes[-1]
+            start = position + 2
+            if start == end:
+                if len(changes) < 2: # calculate_new_partial fails here, too
+                    raise ValueError("no notes after the only \\time change")
+                end = position
+                position, time = changes[-2]
+                start = position + 2
+        notes_duration = self.prefix_durations[end] - self.prefix_durations[start]
+        time = Fraction(time)
+        if partial:
+            notes_duration -= partial
+        missing = time - (notes_duration % time)
+        if missing >= time:
+            return None
+        return missing
+
+def format_duration(duration):
+    """Write a Fraction as lilypond duration, like abjad's encode_partial does.
+
+    Durations that can't be written with dots are written as a multiple of
+    their reciprocal denominator, like '16*5'.
+    """
+    is_power_of_two = lambda n: n & (n - 1) == 0
+    if duration <= 0 or not is_power_of_two(duration.denominator):
+        raise ValueError("can't write {} as lilypond duration".format(duration))
+    for dots in range(4):
+        undotted = duration / (2 - Fraction(1, 2**dots))
+        if undotted.numerator == 1 and is_power_of_two(undotted.denominator):
+            return str(undotted.denominator) + '.' * dots
+    return "{}*{}".format(duration.denominator, duration.numerator)
+
+def read_duration(string):
+    """Read a duration as written by format_duration into a Fraction."""
+    if string.find('*') >= 0:
+        digits, numerator = string.split('*')
+        return Fraction(int(numerator), int(digits))
+    match = re.match(r"(\d+)(\.*)$", string)
+    if match == None:
+        raise ValueError("unknown duration " + string)
+    return parse_duration(match[1], match[2])
+
+block_pattern = re.compile(r"""
+    (?P<comment>%\{.*?%\}|%[^\n]*)
+  | (?P<string>"(?:\\.|[^"\\])*")
+  | (?P<open>\{|<<)
+  | (?P<close>\}|>>)
+  | (?P<word>[^\s{}%"<>]+|[<>])
+  | \s+
+""", re.VERBOSE | re.DOTALL)
+
+def scan_first_level(string, trigger_words):
+    """Find the blocks introduced by trigger_words outside of any other block.
+
+    A block starts at its trigger word and ends with the first {…} or <<…>>
+    after it. Braces in comments and strings don't count. If a trigger word
+    introduces several blocks, they are put together.
+
+    return -- per trigger word, the text of its blocks, '' if there is none
+    """
+    blocks = dict.fromkeys(trigger_words, '')
+    depth = 0
+    start = word = None
+    has_opened = False
+    for match in block_pattern.finditer(string):
+        kind = match.lastgroup
+        if kind == "open":
+            depth += 1
+        elif kind == "close":
+            depth -= 1
+        elif kind == "word" and start == None and depth <= 0 \
+                and match[0] in blocks:
+            start, word = match.start(), match[0]
+        if start != None:
+            has_opened = has_opened or kind == "open"
+            if depth <= 0 and has_opened: # The block is complete
+                blocks[word] += string[start:match.end()]
+                depth = 0
+                start = None
+                has_opened = False
+    if start != None: # Never closed, take the rest
+        blocks[word] += string[start:]
+    return blocks
+
+def read_header_title(header):
+    """Read the title off a \\header block, if it's a plain string.
+
+    Raises a ValueError for titles in \\markup, with escapes or given twice.
+    """
+    tokens = []
+    depth = 0
+    for match in block_pattern.finditer(header):
+        kind = match.lastgroup
+        if kind == "open":
+            depth += 1
+        elif kind == "close":
+            depth -= 1
+        elif kind in ("word", "string") and depth == 1:
+            tokens += [match[0]]
+    titles = [value for name, equals, value
+              in zip(tokens, tokens[1:], tokens[2:])
+              if name == "title" and equals == "="]
+    titles += [value for name, value in zip(tokens, tokens[1:])
+               if name == "title="]
+    if len(titles) != 1 or not titles[0].startswith('"') \
+            or "\\" in titles[0]:
+        raise ValueError("not a plain title")
+    return titles[0][1:-1]
+
+steps = "cdefgab"
+semitones = [0, 2, 4, 5, 7, 9, 11]
+
+def build_pitch_names():
+    """Map each dutch pitch name to its step, alteration and english name."""
+    pitch_names = {}
+    for step, letter in enumerate(steps):
+        for dutch, english, alteration in [("", "", 0),
+                                           ("is", "s", 1),
+                                           ("isis", "ss", 2),
+                                           ("es", "f", -1),
+                                           ("eses", "ff", -2)]:
+            pitch_names[letter + dutch] = (step, alteration, letter + english)
+    # Vowels drop the 'e' of their flats, but the long forms are valid, too
+    for letter in "ae":
+        step = steps.index(letter)
+        pitch_names[letter + "s"] = (step, -1, letter + "f")
+        pitch_names[letter + "ses"] = (step, -2, letter + "ff")
+    return pitch_names
+
+pitch_names = build_pitch_names()
+
+token_pattern = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<command>\\[a-zA-Z]+)
+  | (?P<chord_start><(?!<))
+  | (?P<chord_end>>(?!>))
+  | (?P<pitch>(?P<name>[a-g][a-z]*)(?P<octave>[',]*)(?P<mark>[!?]?))
+  | (?P<rest>[rsR])(?![a-z])
+  | (?P<fraction>\d+/\d+)
+  | (?P<duration>(?P<digits>\d+)(?P<dots>\.*))
+  | (?P<multiplier>\*\s*(?P<factor>\d+(?:/\d+)?))
+  | (?P<symbol>[~()\[\]|])
+""", re.VERBOSE)
+
+def tokenize(notes):
+    """Split lilypond notes into (kind, match) pairs, skipping whitespace."""
+    tokens = []
+    position = 0
+    while position < len(notes):
+        match = token_pattern.match(notes, position)
+        if match == None:
+            raise ValueError("can't read " + notes[position:position + 20])
+        if match.lastgroup != "space":
+            tokens += [(match.lastgroup, match)]
+        position = match.end()
+    return tokens
+
+def get_pitch(name):
+    try:
+        return pitch_names[name]
+    except KeyError:
+        raise ValueError("unknown pitch " + name)
+
+def octave_marks(octave):
+    return "'" * octave if octave > 0 else "," * -octave
+
+def relative_to_absolute(notes, relative):
+    """Turn \\relative notes into absolute ones, formatted as abjad would.
+
+    This follows abjad's take on \\relative rather than lilypond's, so that
+    both paths agree: a pitch goes to the octave bringing it diatonically
+    closest to the one before, but whether it's looked for above or below is
+    decided by comparing pitch classes. Inside a chord, each pitch refers to the
+    one before, after it to the chord's lowest pitch. Like abjad, \\key and
+    \\time are put on lines of their own before the note they apply to.
+
+    notes -- the notes inside the \\relative block, in dutch
+    relative -- the reference pitch of the \\relative block, like "c'"
+    return -- one line per note or command, in english
+    """
+    # Pitches are (step, alteration, octave) with c' in octave 1
+    letter, marks = relative[0], relative[1:]
+    reference = (steps.index(letter), 0, marks.count("'") - marks.count(","))
+    pitch_class = lambda step, alteration: (semitones[step] + alteration) % 12
+
+    def place(name, marks):
+        nonlocal reference
+        step, alteration, english = get_pitch(name)
+        reference_step, reference_alteration, octave = reference
+        if pitch_class(step, alteration) <= pitch_class(reference_step,
+                                                        reference_alteration):
+            octave += 1
+        up = abs(step + 7 * octave - reference_step - 7 * reference[2])
+        down = abs(step + 7 * (octave - 1) - reference_step - 7 * reference[2])
+        if up >= down:
+            octave -= 1
+        octave += marks.count("'") - marks.count(",")
+        reference = (step, alteration, octave)
+        return english + octave_marks(octave)
+
+    tokens = tokenize(notes)
+    leaves = [] # [indicators, written leaf, ties, beams and slurs, is_rest]
+    indicators = []
+    duration = "4"
+    position = 0
+    def peek():
+        if position + 1 < len(tokens):
+            return tokens[position + 1][0]
+        return None
+    def next_token(kind):
+        nonlocal position
+        if peek() != kind:
+            raise ValueError("expected " + kind)
+        position += 1
+        return tokens[position][1]
+
+    while position < len(tokens):
+        kind, match = tokens[position]
+        if kind == "command" and match[0] == "\\time":
+            indicators += [("time", "%%% \\time " + next_token("fraction")[0]
+                                    + " %%%")]
+        elif kind == "command" and match[0] == "\\key":
+            pitch = next_token("pitch")
+            if pitch["octave"] or pitch["mark"]:
+                raise ValueError("unexpected octave in \\key")
+            mode = next_token("command")[0]
+            if mode not in ("\\major", "\\minor"):
+                raise ValueError("unknown mode " + mode)
+            indicators += [("key", "\\key {} {}".format(
+                                            get_pitch(pitch["name"])[2], mode))]
+        elif kind in ("pitch", "rest", "chord_start"):
+            if kind == "pitch":
+                written = place(match["name"], match["octave"]) \
+                          + match["mark"]
+            elif kind == "rest":
+                written = match[0]
+            else:
+                chord = []
+                while peek() == "pitch":
+                    pitch = next_token("pitch")
+                    written = place(pitch["name"], pitch["octave"])
+                    step, alteration, octave = reference
+                    chord += [((step + 7 * octave, alteration),
+                               written + pitch["mark"],
+                               reference)]
+                next_token("chord_end")
+                if not chord:
+                    raise ValueError("empty chord")
+                chord.sort(key=lambda note: note[0]) # Lowest pitch first
+                reference = chord[0][2]
+                written = "<" + " ".join(n for _, n, _ in chord) + ">"
+            # A duration, and its multiplier, carries on to the notes after
+            if peek() == "duration":
+                duration = next_token("duration")[0]
+                if peek() == "multiplier":
+                    duration += " * " + str(Fraction(
+                                        next_token("multiplier")["factor"]))
+            written += duration
+            leaves += [[indicators, written, [], [], kind == "rest"]]
+            indicators = []
+        elif kind == "symbol" and match[0] != "|":
+            if not leaves:
+                raise ValueError(match[0] + " before the first note")
+            symbol = match[0]
+            leaf = leaves[-1]
+            if symbol == "~":
+                if leaf[4]:
+                    raise ValueError("tied rest")
+                leaf[2] += [symbol]
+            else:
+                leaf[3] += [symbol]
+        elif kind != "symbol":
+            raise ValueError("unexpected " + match[0])
+        position += 1
+
+    if not leaves: # abjad formats these in its own way
+        raise ValueError("no notes")
+    if indicators: # Trailing commands go before the last note
+        leaves[-1][0] = leaves[-1][0] + indicators
+
+    lines = []
+    for leaf_indicators, written, ties, spanners, _ in leaves:
+        kinds = [kind for kind, _ in leaf_indicators]
+        if len(set(kinds)) != len(kinds):
+            raise ValueError("several " + kinds[0] + " changes at once")
+        lines += [line for _, line in sorted(leaf_indicators)]
+        # Stopping spanners come first, then the ones being started
+        marks = ties + sorted(spanners, key="])[(".index)
+        lines += [" ".join([written] + marks)]
+    return lines
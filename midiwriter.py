@@ -0,0 +1,185 @@
+"""
+Writing Standard MIDI Files straight from the notes, without lilypond.
+
+For the audio, lilypond engraves every shard just to write its .midi, even
+though the absolute notes made by choir2anki already hold all pitches and
+durations. Here, those notes are read token by token and written as a .midi
+with their tempo, time and key signature. Whenever something isn't
+understood, a ValueError is raised so the caller can fall back to lilypond.
+"""
+
+import struct
+from fractions import Fraction
+from lilytokens import tokenize, parse_duration, pitch_names, semitones
+
+ticks_per_quarter = 384 # Like lilypond, fine enough for triplets of 64ths
+velocity = 86 # mezzo forte, on lilypond's scale of dynamics
+program = 0 # acoustic grand, lilypond's default instrument
+
+# The absolute notes are in english, so their pitches are looked up by those
+english_pitches = {english: (step, alteration)
+                   for step, alteration, english in pitch_names.values()}
+
+def get_english_pitch(name):
+    try:
+        return english_pitches[name]
+    except KeyError:
+        raise ValueError("unknown pitch " + name)
+
+def midi_key(name, octave_marks):
+    '''Return the MIDI key number of an english pitch name like "ef,".'''
+    step, alteration = get_english_pitch(name)
+    octave = octave_marks.count("'") - octave_marks.count(",")
+    key = 48 + 12 * octave + semitones[step] + alteration # c' is 60
+    if not 0 <= key < 128:
+        raise ValueError("pitch out of MIDI range " + name + octave_marks)
+    return key
+
+def fifths(name, mode):
+    '''Return the sharps, or negative flats, of a key like "ef", "\\major".'''
+    step, alteration = get_english_pitch(name)
+    sharps = [0, 2, 4, -1, 1, 3, 5][step] + 7 * alteration
+    if mode == "\\minor":
+        sharps -= 3
+    if not -7 <= sharps <= 7:
+        raise ValueError("key signature out of MIDI range " + name)
+    return sharps
+
+def read_notes(notes):
+    """Read absolute notes into the notes and signatures they are played with.
+
+    Ties join notes of the same pitch, a chord sounds all its pitches at once.
+    A \\partial only moves the bar lines, so the first note still starts at 0.
+
+    notes -- absolute notes in english, optionally preceded by \\key, \\time
+             and \\partial, like the global options of a shard
+    return -- the notes as (start, duration, key), the signatures as (start,
+              kind, values) and the end, all positions as Fractions of whole
+              notes
+    """
+    tokens = tokenize(notes)
+    played = []
+    signatures = []
+    position = Fraction(0)
+    duration = Fraction(1, 4)
+    last_leaf = [] # The indices of the notes of the leaf before
+    tied = {} # The keys tied from the leaf before, to the index of their note
+    index = 0
+    def peek():
+        if index + 1 < len(tokens):
+            return tokens[index + 1][0]
+        return None
+    def next_token(kind):
+        nonlocal index
+        if peek() != kind:
+            raise ValueError("expected " + kind)
+        index += 1
+        return tokens[index][1]
+
+    while index < len(tokens):
+        kind, match = tokens[index]
+        if kind == "command" and match[0] == "\\time":
+            numerator, denominator = map(int,
+                                         next_token("fraction")[0].split("/"))
+            if denominator & (denominator - 1):
+                raise ValueError("time signature out of MIDI range")
+            signatures += [(position, "time", (numerator, denominator))]
+        elif kind == "command" and match[0] == "\\key":
+            name = next_token("pitch")["name"]
+            mode = next_token("command")[0]
+            if mode not in ("\\major", "\\minor"):
+                raise ValueError("unknown mode " + mode)
+            signatures += [(position, "key", (fifths(name, mode),
+                                              mode == "\\minor"))]
+        elif kind == "command" and match[0] == "\\partial":
+            next_token("duration")
+        elif kind in ("pitch", "rest", "chord_start"):
+            if kind == "pitch":
+                chord = [midi_key(match["name"], match["octave"])]
+            elif kind == "rest":
+                chord = []
+            else:
+                chord = []
+                while peek() == "pitch":
+                    pitch = next_token("pitch")
+                    chord += [midi_key(pitch["name"], pitch["octave"])]
+                next_token("chord_end")
+                if not chord:
+                    raise ValueError("empty chord")
+            if peek() == "duration":
+                written = next_token("duration")
+                duration = parse_duration(written["digits"], written["dots"])
+            length = duration
+            if peek() == "multiplier":
+                factor = next_token("multiplier")["factor"].split("/")
+                length *= Fraction(int(factor[0]), int((factor + ["1"])[1]))
+
+            last_leaf = []
+            for key in chord:
+                if key in tied: # Held on instead of played again
+                    note = tied[key]
+                    start, held, _ = played[note]
+                    played[note] = (start, held + length, key)
+                else:
+                    note = len(played)
+                    played += [(position, length, key)]
+                last_leaf += [note]
+            tied = {}
+            position += length
+        elif kind == "symbol" and match[0] == "~":
+            tied = {played[note][2]: note for note in last_leaf}
+        elif kind != "symbol":
+            raise ValueError("unexpected " + match[0])
+        index += 1
+    return played, signatures, position
+
+def variable_length(number):
+    '''Encode a number as a MIDI variable-length quantity.'''
+    encoded = [number & 0x7f]
+    number >>= 7
+    while number:
+        encoded.insert(0, 0x80 | (number & 0x7f))
+        number >>= 7
+    return bytes(encoded)
+
+def write_midi(notes, global_options="", tempo="4=100"):
+    """Turn a shard's notes into the bytes of a Standard MIDI File.
+
+    notes -- absolute notes in english, as made by create_absolute_notes
+    global_options -- the \\key, \\time and \\partial the notes start with
+    tempo -- a lilypond tempo like "4=100"
+    return -- the .midi, as bytes
+    """
+    played, signatures, end = read_notes(global_options + " " + notes)
+    beat, beats_per_minute = tempo.split("=")
+    if not beat.isdigit() or not beats_per_minute.isdigit():
+        raise ValueError("unknown tempo " + tempo)
+    microseconds_per_quarter = round(60 * 10**6 * int(beat)
+                                     / int(beats_per_minute) / 4)
+
+    ticks = lambda position: round(position * 4 * ticks_per_quarter)
+    # At the same time, signatures come first and notes end before others start
+    events = [(0, 0, b"\xff\x51\x03"
+                     + microseconds_per_quarter.to_bytes(3, "big"))]
+    for position, kind, values in signatures:
+        if kind == "time":
+            numerator, denominator = values
+            data = bytes([0xff, 0x58, 4, numerator,
+                          denominator.bit_length() - 1, 24, 8])
+        else:
+            data = b"\xff\x59\x02" + struct.pack(">bB", *values)
+        events += [(ticks(position), 0, data)]
+    events += [(0, 0, bytes([0xc0, program]))]
+    for start, duration, key in played:
+        events += [(ticks(start), 2, bytes([0x90, key, velocity])),
+                   (ticks(start + duration), 1, bytes([0x80, key, 0]))]
+    events.sort(key=lambda event: event[:2])
+
+    track = b""
+    now = 0
+    for tick, _, data in events:
+        track += variable_length(tick - now) + data
+        now = tick
+    track += variable_length(max(ticks(end) - now, 0)) + b"\xff\x2f\x00"
+    return (b"MThd" + struct.pack(">IHHH", 6, 0, 1, ticks_per_quarter)
+            + b"MTrk" + struct.pack(">I", len(track)) + track)
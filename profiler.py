@@ -0,0 +1,111 @@
+"""
+Timing of the stages of a run, to find out where the time of a song goes.
+
+Stages are timed with the stage context manager of the shared profiler. A
+stage started inside another one inherits its label, so the external tools run
+while rendering a shard are attributed to that shard, even when many shards
+are rendered concurrently by asyncio tasks.
+"""
+
+import collections
+import contextlib
+import contextvars
+import json
+import time
+
+class Profiler:
+    """Collects the durations of stages and counts of events, when enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.events = [] # (stage, label, seconds)
+        self.counters = collections.Counter()
+        # Labels are tracked per thread and asyncio task
+        self.labels = contextvars.ContextVar("labels", default=("",))
+
+    @contextlib.contextmanager
+    def stage(self, name, label=None):
+        '''Time the code inside the with block as a stage called name.'''
+        if not self.enabled:
+            yield
+            return
+        labels = self.labels.get()
+        if label is None:
+            label = labels[-1]
+        token = self.labels.set(labels + (label,))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.events.append((name, label, time.perf_counter() - start))
+            self.labels.reset(token)
+
+    @contextlib.contextmanager
+    def label(self, label):
+        '''Label the stages inside the with block, without timing the block.
+
+        All render tasks start at once and then mostly wait for their turn at
+        the tools, so timing a whole task would mostly time its waiting.
+        '''
+        if not self.enabled:
+            yield
+            return
+        token = self.labels.set(self.labels.get() + (label,))
+        try:
+            yield
+        finally:
+            self.labels.reset(token)
+
+    def count(self, name, number=1):
+        '''Count an event, like a cache hit.'''
+        if self.enabled:
+            self.counters[name] += number
+
+    def collect(self):
+        '''Return and forget everything recorded so far.'''
+        timings = self.events, dict(self.counters)
+        self.events = []
+        self.counters = collections.Counter()
+        return timings
+
+    def report(self, wall_time):
+        '''Return all stages, totalled and one by one, and the counters.'''
+        stages = {}
+        for name, _, seconds in self.events:
+            stage = stages.setdefault(name, {"calls": 0, "total": 0.0,
+                                             "max": 0.0})
+            stage["calls"] += 1
+            stage["total"] += seconds
+            stage["max"] = max(stage["max"], seconds)
+        return {"wall_time": wall_time,
+                "stages": stages,
+                "counters": dict(self.counters),
+                "events": [{"stage": name, "label": label, "seconds": seconds}
+                           for name, label, seconds in self.events]}
+
+    def summary(self, report):
+        '''Format a report as a table, the slowest stages first.
+
+        Nested stages are part of the stages around them, and stages run
+        concurrently can add up to more than the wall time.
+        '''
+        lines = ["{:<28}{:>7}{:>11}{:>11}".format("stage", "calls", "total s",
+                                                  "max s")]
+        stages = sorted(report["stages"].items(),
+                        key=lambda item: -item[1]["total"])
+        for name, stage in stages:
+            lines += ["{:<28}{:>7}{:>11.3f}{:>11.3f}".format(
+                            name, stage["calls"], stage["total"], stage["max"])]
+        for name, number in sorted(report["counters"].items()):
+            lines += ["{:<28}{:>7}".format(name, number)]
+        lines += ["{:<28}{:>18.3f}".format("wall time", report["wall_time"])]
+        return "\n".join(lines)
+
+    def write_report(self, file_name, wall_time):
+        '''Write the report as JSON to file_name and return its summary.'''
+        report = self.report(wall_time)
+        with open(file_name, 'w') as report_file:
+            json.dump(report, report_file, indent=1)
+        return self.summary(report)
+
+profiler = Profiler()
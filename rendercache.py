@@ -0,0 +1,105 @@
+"""
+A persistent cache for rendered media, addressed by the content it depends on.
+
+Entries are keyed by a hash of the filled lilypond template, the external
+tools involved and the flags they are called with. Once a build has stored
+its media, the least recently used entries beyond the size limit are evicted.
+"""
+
+import functools
+import hashlib
+import os
+import shutil
+import tempfile
+from profiler import profiler
+
+default_cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                                os.path.expanduser("~/.cache")),
+                                 "choir2anki")
+default_max_size = 512 * 1024**2 # bytes
+
+@functools.lru_cache(maxsize=None)
+def tool_fingerprint(tool):
+    '''Identify the installed version of an external tool without running it.
+
+    Resolving the executable and looking at its size and modification time is
+    enough to notice upgrades, and doesn't cost a process launch.
+    '''
+    path = shutil.which(tool)
+    if path is None:
+        return tool + ":missing"
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return "{}:{}:{}:{}".format(tool, path, stat.st_size, int(stat.st_mtime))
+
+class RenderCache:
+    """A directory of rendered files, evicted least recently used first.
+
+    cache_dir -- where to store the rendered files
+    max_size -- the size in bytes the cache is trimmed to by evict
+    """
+
+    def __init__(self, cache_dir=default_cache_dir, max_size=default_max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def key(self, source, tools, flags=()):
+        '''Hash the filled template together with the tools and their flags.'''
+        digest = hashlib.sha256()
+        for part in [source] + [tool_fingerprint(t) for t in tools] + list(flags):
+            digest.update(part.encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key[:2], key + suffix)
+
+    def fetch(self, key, suffix, target):
+        '''Copy a cached file to target. Return whether it was cached.'''
+        path = self._path(key, suffix)
+        try:
+            shutil.copyfile(path, target)
+        except FileNotFoundError:
+            profiler.count("cache misses")
+            return False
+        os.utime(path) # Mark as recently used
+        profiler.count("cache hits")
+        return True
+
+    def store(self, key, suffix, source):
+        '''Add a copy of the file at source to the cache.'''
+        path = self._path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Copy next to the destination first, so that concurrent renders
+        # never see a half written entry.
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        os.close(handle)
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits.
+
+        This walks the whole cache, so it is done once per build rather than
+        after every store.
+        """
+        entries = []
+        total_size = 0
+        for directory, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError: # Evicted by a concurrent render
+                    continue
+                entries += [(stat.st_mtime, stat.st_size, path)]
+                total_size += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
@@ -0,0 +1,108 @@
+"""
+A long-running choir2anki, building decks for clients on a Unix socket.
+
+Every run of choir2anki has to import abjad and genanki and build parsers
+before it can render anything. Started with 'choir2anki.py serve', a daemon
+does this once and then keeps everything loaded. Clients send it their
+working directory and command line arguments. Jobs are queued and run one
+after the other, and each client gets back what its build printed and the
+paths of its decks.
+"""
+
+import contextlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import tempfile
+import threading
+import traceback
+
+default_socket_path = os.path.join(os.environ.get("XDG_RUNTIME_DIR",
+                                                  tempfile.gettempdir()),
+                                   "choir2anki-{}.sock".format(os.getuid()))
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Runs the job sent by a client and replies with its outcome."""
+
+    def handle(self):
+        job = json.loads(self.rfile.readline().decode())
+        output = io.StringIO()
+        # Jobs change the working directory of the whole daemon, so only one
+        # runs at a time while the others wait for the lock.
+        with self.server.job_lock:
+            working_directory = os.getcwd()
+            try:
+                os.chdir(job["cwd"])
+                with contextlib.redirect_stdout(output):
+                    reply = {"decks": self.server.run_job(job["arguments"])}
+            except Exception:
+                reply = {"error": traceback.format_exc()}
+            finally:
+                os.chdir(working_directory)
+        reply["output"] = output.getvalue()
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, run_job):
+        self.run_job = run_job
+        self.job_lock = threading.Lock()
+        super().__init__(socket_path, JobHandler)
+
+def is_serving(socket_path):
+    '''Return whether a daemon accepts connections on socket_path.'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+def serve(run_job, socket_path=default_socket_path):
+    """Serve jobs on socket_path until interrupted or terminated.
+
+    run_job -- called with the arguments of each job, in the client's working
+               directory, returning the paths of the written decks
+    """
+    if os.path.exists(socket_path):
+        if is_serving(socket_path):
+            raise RuntimeError("a daemon is already serving " + socket_path)
+        os.remove(socket_path) # Left behind by a daemon that died
+    with DaemonServer(socket_path, run_job) as server:
+        os.chmod(socket_path, 0o600) # Jobs run with the daemon's rights
+        print("Serving on " + socket_path)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+def submit_job(arguments, socket_path=default_socket_path):
+    """Have the daemon run a job in the current working directory.
+
+    What the job printed is printed here as well. Raises an OSError if no
+    daemon is listening, and a RuntimeError carrying the daemon's traceback if
+    the job failed.
+
+    arguments -- the command line arguments, as a dict
+    return -- the paths of the written decks
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        job = {"cwd": os.getcwd(), "arguments": arguments}
+        connection.sendall(json.dumps(job).encode() + b"\n")
+        with connection.makefile('rb') as reply_file:
+            reply_line = reply_file.readline()
+    if not reply_line:
+        raise ConnectionError("the daemon hung up")
+    reply = json.loads(reply_line.decode())
+    print(reply["output"], end='')
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply["decks"]
@@ -0,0 +1,72 @@
+"""
+Rebuilding the decks whenever their sources are saved, while arranging.
+
+Started with --watch, choir2anki stays alive after the first build and polls
+the modification times of its sources. Once a save has settled, the decks are
+built again in the same process: abjad and genanki stay imported, the parses
+and shard splits of unchanged voices are remembered, and the manifests let
+unchanged shards keep their media, so only the edited shards are rendered.
+"""
+
+import os
+import time
+import traceback
+
+poll_interval = 0.25 # seconds between two looks at the sources
+
+def snapshot(paths):
+    '''Return the modification time and size of each path, None if missing.'''
+    state = {}
+    for path in paths:
+        try:
+            status = os.stat(path)
+            state[path] = (status.st_mtime_ns, status.st_size)
+        except OSError:
+            state[path] = None
+    return state
+
+def wait_for_change(find_paths, state, interval=poll_interval):
+    """Wait until the sources differ from state and stay the same a while.
+
+    Editors may save a file in several writes, or replace it by another one,
+    so a change only counts once a second look finds the same sources.
+
+    find_paths -- called without arguments, returns the paths of the sources
+    state -- the snapshot of the sources to compare with
+    return -- the snapshot of the changed sources
+    """
+    changed = state
+    while True:
+        time.sleep(interval)
+        current = snapshot(find_paths())
+        if current == changed and current != state:
+            return current
+        changed = current
+
+def watch(build, find_paths, interval=poll_interval):
+    """Build, then build again whenever the sources change, until interrupted.
+
+    A failing build, like one of a source saved halfway through an edit, is
+    reported and the sources are watched on.
+
+    build -- called without arguments to build the decks
+    find_paths -- called without arguments, returns the paths of the sources
+    interval -- seconds between two looks at the sources
+    """
+    # Taken before building, so that saves during a build are not missed
+    state = snapshot(find_paths())
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                build()
+                outcome = "Rebuilt"
+            except Exception:
+                traceback.print_exc()
+                outcome = "Failed"
+            print("{} in {:.2f}s, watching {} for changes (Ctrl+C to "
+                  "stop)".format(outcome, time.perf_counter() - start,
+                                 ", ".join(sorted(state))))
+            state = wait_for_change(find_paths, state, interval)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,81 @@
+"""
+Synthesizing the notes of a voice with numpy, instead of timidity.
+
+A voice to learn only needs a clear tone per note, not a sampled instrument.
+Here, the notes read by midiwriter are turned into raw PCM like timidity's,
+from a few harmonics and a simple envelope. Notes of the same length share
+their envelope, so they are synthesized together, a block of them per numpy
+operation.
+
+Dependencies: numpy, imported once something is synthesized
+"""
+
+import collections
+
+# The relative amplitudes of the harmonics of each timbre, and how fast its
+# notes fade while they are held, in 1/s
+timbres = {"sine": ([1.0], 0.0),
+           "organ": ([1.0, 0.5, 0.3, 0.2], 0.0),
+           "piano": ([1.0, 0.5, 0.25, 0.15, 0.1], 2.5)}
+attack = 0.005 # seconds from silence to full volume
+release = 0.08 # seconds to fade out after a note ends
+loudness = 0.25 # of the loudest 16 bit sample, per note
+block_size = 64 # notes synthesized at once, to bound the memory needed
+
+def amplitude_scale(harmonics):
+    '''Return the factor bringing a note of harmonics to its loudness.'''
+    return loudness * 32767 / sum(harmonics)
+
+def envelope(numpy, samples, held, sample_rate, decay):
+    '''Return the volume over the samples of a note held for held samples.'''
+    time = numpy.arange(samples) / sample_rate
+    volume = numpy.minimum(time / attack, 1) * numpy.exp(-decay * time)
+    fading = numpy.arange(samples) >= held
+    volume[fading] *= numpy.maximum(1 - (time[fading] - held / sample_rate)
+                                    / release, 0)
+    return volume
+
+def synthesize(played, end, seconds_per_whole_note, sample_rate=44100,
+               channels=2, timbre="piano"):
+    """Synthesize notes into raw PCM, like timidity writes it.
+
+    played -- the notes as (start, duration, key), as read by read_notes
+    end -- where the notes end, in whole notes
+    seconds_per_whole_note -- how long a whole note lasts
+    sample_rate -- samples per second
+    channels -- 1 for mono, 2 for stereo with the same sound on both sides
+    timbre -- one of timbres
+    return -- signed 16 bit little-endian samples, one per channel, as bytes
+    """
+    import numpy
+    harmonics, decay = timbres[timbre]
+    samples_per_whole_note = seconds_per_whole_note * sample_rate
+    release_samples = round(release * sample_rate)
+    pcm = numpy.zeros(round(end * samples_per_whole_note) + release_samples
+                      + 1)
+
+    lengths = collections.defaultdict(list)
+    for start, duration, key in played:
+        offset = round(start * samples_per_whole_note)
+        held = round((start + duration) * samples_per_whole_note) - offset
+        lengths[held] += [(offset, key)]
+    for held, notes in lengths.items():
+        samples = held + release_samples
+        volume = envelope(numpy, samples, held, sample_rate, decay) \
+                 * amplitude_scale(harmonics)
+        phase = 2 * numpy.pi * numpy.arange(samples) / sample_rate
+        for block in range(0, len(notes), block_size):
+            offsets, keys = zip(*notes[block:block + block_size])
+            frequencies = 440 * 2 ** ((numpy.array(keys) - 69) / 12)
+            waves = numpy.zeros((len(keys), samples))
+            for harmonic, amplitude in enumerate(harmonics, 1):
+                # Harmonics above the Nyquist frequency would alias
+                audible = harmonic * frequencies < sample_rate / 2
+                waves += (amplitude * audible)[:, None] * numpy.sin(
+                                harmonic * numpy.outer(frequencies, phase))
+            waves *= volume
+            for offset, wave in zip(offsets, waves):
+                pcm[offset:offset + samples] += wave
+
+    pcm = numpy.clip(numpy.round(pcm), -32768, 32767).astype("<i2")
+    return numpy.repeat(pcm, channels).tobytes()
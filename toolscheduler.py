@@ -0,0 +1,158 @@
+"""
+Running the external tools of choir2anki from asyncio, a few at a time.
+
+Every tool gets its own limit of concurrent runs, so while one shard waits for
+lilypond to write its .midi, another one's .pngs can be typeset by latex. Each
+command gets a timeout, its stderr is kept for the error raised when it fails,
+and failed or hung commands are retried a number of times before giving up.
+"""
+
+import asyncio
+import contextlib
+import itertools
+import os
+import signal
+import subprocess
+from profiler import profiler
+
+class ToolError(subprocess.CalledProcessError):
+    """A CalledProcessError showing the end of what the tool complained."""
+
+    def __str__(self):
+        message = super().__str__()
+        # latex and dvipng report their errors on stdout
+        complaint = self.stderr or self.output or b""
+        lines = complaint.decode(errors="replace").strip().splitlines()
+        if lines:
+            message += "\n" + "\n".join(lines[-20:])
+        return message
+
+class ToolScheduler:
+    """Runs external commands, at most jobs of them per tool at once.
+
+    jobs -- runs per tool at once, None for one per CPU core
+    timeout -- seconds before a command is killed, None for no limit
+    retries -- how often a failed or timed out command is run again
+    """
+
+    def __init__(self, jobs=1, timeout=None, retries=0):
+        self.jobs = jobs or os.cpu_count()
+        self.timeout = timeout
+        self.retries = retries
+        self.limits = {} # Made in the running event loop, when first needed
+
+    def _limit(self, tool):
+        if tool not in self.limits:
+            self.limits[tool] = asyncio.Semaphore(self.jobs)
+        return self.limits[tool]
+
+    async def run(self, args, input=None, cwd=None):
+        """Run a command, raising a ToolError if it fails.
+
+        input -- bytes to pass on stdin, if any
+        cwd -- the working directory of the command
+        return -- what the command wrote to stdout
+        """
+        return await self.pipe([args], input, cwd)
+
+    async def pipe(self, commands, input=None, cwd=None):
+        """Run commands with the stdout of each one piped into the next one.
+
+        The commands count as one, for their timeout and retries.
+
+        commands -- the commands, each a list of arguments
+        input -- bytes to pass on stdin to the first command, if any
+        cwd -- the working directory of the commands
+        return -- what the last command wrote to stdout
+        """
+        tools = [os.path.basename(args[0]) for args in commands]
+        for attempt in itertools.count():
+            try:
+                # Acquire in a fixed order, so that pipes can't deadlock
+                async with contextlib.AsyncExitStack() as stack:
+                    for tool in sorted(set(tools)):
+                        await stack.enter_async_context(self._limit(tool))
+                    with profiler.stage(" | ".join(tools)):
+                        return await self._run_once(commands, input, cwd)
+            except (subprocess.CalledProcessError,
+                    subprocess.TimeoutExpired):
+                if attempt >= self.retries:
+                    raise
+                profiler.count("tool retries")
+
+    async def call(self, name, function, *args):
+        """Call a python function in a worker thread, as if it were a tool.
+
+        Like the runs of a tool, at most jobs calls of the same name run at
+        once. Functions spending their time in numpy release the GIL, so they
+        keep several cores busy.
+
+        name -- the name to limit and profile the calls by
+        return -- what the function returned
+        """
+        async with self._limit(name):
+            with profiler.stage(name):
+                return await asyncio.get_running_loop().run_in_executor(
+                                                        None, function, *args)
+
+    async def _run_once(self, commands, input, cwd):
+        processes = []
+        communicating = None
+        try:
+            await self._start(commands, input, cwd, processes)
+            communicating = asyncio.gather(*[process.communicate(
+                                                input if number == 0 else None)
+                                             for number, process
+                                             in enumerate(processes)])
+            outputs = await asyncio.wait_for(asyncio.shield(communicating),
+                                             self.timeout)
+        except asyncio.TimeoutError:
+            raise subprocess.TimeoutExpired(commands[-1],
+                                            self.timeout) from None
+        finally:
+            # Don't leave anything running after a timeout or an error. asyncio
+            # doesn't always clean up after processes cancelled while starting
+            # or communicating, so they are killed and waited for instead.
+            # Their children, like the ghostscript of lilypond, go with them.
+            for process in processes:
+                if process.returncode is None:
+                    os.killpg(process.pid, signal.SIGKILL)
+            if communicating:
+                await communicating
+            for process in processes:
+                await process.wait()
+
+        for args, process, (stdout, stderr) in zip(commands, processes,
+                                                   outputs):
+            if process.returncode != 0:
+                raise ToolError(process.returncode, args, stdout, stderr)
+        return outputs[-1][0]
+
+    async def _start(self, commands, input, cwd, processes):
+        stdin = subprocess.PIPE if input is not None else subprocess.DEVNULL
+        for number, args in enumerate(commands):
+            stdout = next_stdin = subprocess.PIPE
+            if number < len(commands) - 1:
+                next_stdin, stdout = os.pipe()
+            try:
+                starting = asyncio.ensure_future(
+                                asyncio.create_subprocess_exec(
+                                                *args, stdin=stdin,
+                                                stdout=stdout,
+                                                stderr=subprocess.PIPE,
+                                                cwd=cwd,
+                                                start_new_session=True))
+                try:
+                    await asyncio.shield(starting)
+                finally: # Even when cancelled, so that it can be killed
+                    processes += [await starting]
+            except BaseException:
+                if next_stdin != subprocess.PIPE:
+                    os.close(next_stdin)
+                raise
+            finally: # The processes hold on to their ends of the pipes
+                if stdout != subprocess.PIPE:
+                    os.close(stdout)
+                if stdin not in (subprocess.PIPE, subprocess.DEVNULL):
+                    os.close(stdin)
+            stdin = next_stdin
@@ -0,0 +1,58 @@
+"""
+Private directories for the files a build writes on its way to the decks.
+
+Rendering writes lots of short-lived intermediate files: filled templates,
+.midi files, and the .tex, .dvi and aux files of latex. They go to a directory
+of their own, in memory under /dev/shm where there is one, so they never touch
+the disk. The finished media wait in a second directory, under the temp
+directory, until all decks are written. A whole songbook's media would not fit
+in a small tmpfs. Being unique to the build, both directories keep two builds
+in the same directory from clobbering each other's files. The tools get
+absolute paths into them, so the working directory is never changed.
+"""
+
+import os
+import shutil
+import tempfile
+
+def default_root():
+    '''Return /dev/shm if files can be made there, else the temp directory.'''
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK | os.X_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+class Workspace:
+    """Unique directories for the intermediate files and media of a build.
+
+    root -- where to make the directory of intermediate files, None for
+            default_root()
+    keep -- keep the directories and everything in them when closed, to debug
+    """
+
+    def __init__(self, root=None, keep=False):
+        root = os.path.abspath(root or default_root())
+        self.directory = tempfile.mkdtemp(prefix="choir2anki-", dir=root)
+        self.media_directory = tempfile.mkdtemp(prefix="choir2anki-media-")
+        self.keep = keep
+
+    def path(self, name):
+        '''Return the absolute path of the intermediate file called name.'''
+        return os.path.join(self.directory, name)
+
+    def media_path(self, name):
+        '''Return the absolute path of the media file called name.'''
+        return os.path.join(self.media_directory, name)
+
+    def close(self):
+        if self.keep:
+            print("Kept the intermediate files in {} and the media in "
+                  "{}".format(self.directory, self.media_directory))
+        else:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            shutil.rmtree(self.media_directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()